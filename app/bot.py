@@ -4,15 +4,15 @@ from aiogram.enums.parse_mode import ParseMode
 
 from app.settings import settings
 from app.middlewares.error_logging import ErrorsLoggingMiddleware
+from app.middlewares.throttling import OutboundLimiter
 from app.routers import brands as brands_router
 from app.routers import main as main_router
 from app.routers import ai_helper as ai_helper_router  # <-- новый роутер
-from app.routers import admin_tools as admin_tools_router
-from app.routers import posm as posm_router
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s — %(levelname)s — %(message)s")
 
 bot = Bot(settings.api_token, parse_mode=ParseMode.HTML)
+bot.session.middleware(OutboundLimiter())  # все send_* проходят через общий лимит
 dp = Dispatcher()
 dp.message.middleware(ErrorsLoggingMiddleware())
 
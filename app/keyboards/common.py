@@ -20,5 +20,7 @@ def ai_entry_kb():
     kb.button(text="🤖 AI-помощник", callback_data="ai:enter")
     return kb.as_markup()
 
-def categories_kb():
-    return kb("🍷 Вино", "🧊 Водка", "🥃 Виски", "🍺 Пиво", "🦌 Ягермейстер", "Назад", width=2)
+CATEGORIES_KB = kb("🍷 Вино", "🧊 Водка", "🥃 Виски", "🍺 Пиво", "🦌 Ягермейстер", "Назад", width=2)
+
+def categories_kb() -> ReplyKeyboardMarkup:
+    return CATEGORIES_KB
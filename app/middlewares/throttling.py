@@ -0,0 +1,36 @@
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
+
+# Лимиты Telegram: ~30 сообщений/сек на бота и ~1/сек в один чат (короткие всплески допустимы)
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """Ограничивает исходящие send_* на уровне сессии бота — до Telegram,
+    а не через 429 и повторы. Остальные методы (edit, answer_callback…) не трогаем."""
+    def __init__(self):
+        self._global = AsyncLimiter(GLOBAL_RATE, 1)
+        # лимитеры чатов живут, пока чат активен: удаляются после минуты простоя
+        self._chats: TTLCache = TTLCache(maxsize=10000, ttl=60)
+
+    def _chat_limiter(self, chat_id) -> AsyncLimiter:
+        lim = self._chats.get(chat_id)
+        if lim is None:
+            lim = AsyncLimiter(CHAT_BURST, CHAT_BURST / CHAT_RATE)
+        # TTLCache считает срок от вставки, а не от чтения — переставляем при каждом
+        # использовании, иначе лимитер активного чата сбросится посреди всплеска
+        self._chats[chat_id] = lim
+        return lim
+
+    async def __call__(self, make_request, bot, method):
+        if not type(method).__name__.startswith("Send"):
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is not None:
+            async with self._chat_limiter(chat_id):
+                async with self._global:
+                    return await make_request(bot, method)
+        async with self._global:
+            return await make_request(bot, method)
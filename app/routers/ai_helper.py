@@ -5,15 +5,24 @@ import asyncio
 import time
 import logging
 import re
-import difflib
 import json
 from pathlib import Path
 from contextlib import suppress
 from typing import Optional, Tuple
 
+from rapidfuzz import fuzz, process
+
+try:
+    import orjson
+    _jloads = orjson.loads
+except Exception:
+    _jloads = json.loads
+
 from aiogram import Router, F
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
 from aiogram.types import KeyboardButton
 
@@ -35,10 +44,17 @@ except Exception:
 
 # ---- LLM (по желанию; используется ТОЛЬКО поверх KB, а не веба) ----
 try:
-    from app.services.ai_gemini import generate_caption_with_gemini, generate_sales_playbook_with_gemini
+    from app.services.ai_gemini import (
+        generate_caption_with_gemini,
+        generate_sales_playbook_with_gemini,
+        stream_sales_playbook_with_gemini,
+        _smart_trim,
+    )
 except Exception:
     generate_caption_with_gemini = None
     generate_sales_playbook_with_gemini = None
+    stream_sales_playbook_with_gemini = None
+    def _smart_trim(text: str, limit: int) -> str: return text[:limit]
 
 log = logging.getLogger(__name__)
 router = Router()
@@ -46,7 +62,9 @@ router = Router()
 # =========================
 # Состояние AI-режима / антиспам
 # =========================
-AI_USERS: set[int] = set()
+class AIStates(StatesGroup):
+    active = State()   # пользователь в AI-режиме; роутеры брендов работают только вне состояний
+
 _USER_LOCKS: dict[int, asyncio.Lock] = {}
 _USER_LAST: dict[int, float] = {}
 _COOLDOWN = 4.0  # сек между запросами
@@ -88,24 +106,105 @@ AI_EXIT_TEXT  = MENU_AI_EXIT
 # Санитайзер для подписи Telegram
 # =========================
 _ALLOWED_TAGS = {"b", "i", "u", "s", "a", "code", "pre", "br"}
+_BLOCK_TAG_RE = re.compile(r"</?(?:h[1-6]|p|ul|ol|li)>", re.I)
+_STRONG_EM_RE = re.compile(r"<\s*(/\s*)?(strong|em)\s*>", re.I)   # strong→b, em→i одним проходом
+_ANY_TAG_RE = re.compile(r"</?([a-z0-9]+)(?:\s+[^>]*)?>")
+_MANY_NL_RE = re.compile(r"\n{3,}")
+
+def _strong_em(m: re.Match) -> str:
+    return ("</" if m.group(1) else "<") + ("b" if m.group(2).lower() == "strong" else "i") + ">"
+
+def _strip_tag(m: re.Match) -> str:
+    tag = m.group(1).lower()
+    return m.group(0) if tag in _ALLOWED_TAGS else ""
 
 def _sanitize_caption(html: str, limit: int = 1000) -> str:
     if not html:
         return ""
-    html = re.sub(r"</?(?:h[1-6]|p|ul|ol|li)>", "", html, flags=re.I)
-    html = re.sub(r"<\s*strong\s*>", "<b>", html, flags=re.I)
-    html = re.sub(r"<\s*/\s*strong\s*>", "</b>", html, flags=re.I)
-    html = re.sub(r"<\s*em\s*>", "<i>", html, flags=re.I)
-    html = re.sub(r"<\s*/\s*em\s*>", "</i>", html, flags=re.I)
-    def _strip_tag(m):
-        tag = m.group(1).lower()
-        return m.group(0) if tag in _ALLOWED_TAGS else ""
-    html = re.sub(r"</?([a-z0-9]+)(?:\s+[^>]*)?>", _strip_tag, html)
-    html = re.sub(r"\n{3,}", "\n\n", html).strip()
+    html = _BLOCK_TAG_RE.sub("", html)
+    html = _STRONG_EM_RE.sub(_strong_em, html)
+    html = _ANY_TAG_RE.sub(_strip_tag, html)
+    html = _MANY_NL_RE.sub("\n\n", html).strip()
     if len(html) > limit:
         html = html[:limit-1].rstrip() + "…"
     return html
 
+# =========================
+# Потоковый ответ: показываем текст по мере генерации
+# =========================
+_STREAM_EDIT_EVERY = 0.8  # сек между правками (у Telegram лимит на edit)
+_STREAM_LIMIT = 950       # как у непотоковой версии (_smart_trim(…, 950) в ai_gemini)
+_PARTIAL_TAG_RE = re.compile(r"<[^>]*(?:>|$)")
+
+def _plain_preview(text: str, limit: int = 4000) -> str:
+    # промежуточный текст — без тегов: незакрытый HTML Telegram не примет
+    return _PARTIAL_TAG_RE.sub("", text).strip()[:limit]
+
+async def _edit_preview(msg: Message, text: str) -> None:
+    # правка-превью не должна обрывать чтение стрима: любую ошибку Telegram
+    # (RetryAfter, сеть, «message is not modified») только логируем
+    try:
+        await msg.edit_text(_plain_preview(text) or "…", parse_mode=None)
+    except TelegramAPIError as e:
+        log.debug("[AI] stream preview edit skipped: %s", e)
+
+async def _answer_streamed(m: Message, chunks) -> bool:
+    """Первое сообщение — сразу после первого куска, дальше правим его.
+    Финальная правка — уже в HTML. False — если модель не отдала ни куска
+    (тогда вызывающий пробует другой путь). Если стрим оборвался после первого
+    куска — дописываем то, что успели получить, и второго сообщения не шлём."""
+    text = ""
+    msg = None
+    last = 0.0
+    try:
+        while True:
+            # ошибки модели ловим только здесь — сбои Telegram стрим не обрывают
+            try:
+                delta = await chunks.__anext__()
+            except StopAsyncIteration:
+                break
+            except Exception as e:
+                if msg is None:
+                    log.warning("[AI] stream failed before first chunk: %s", e)
+                    return False
+                log.warning("[AI] stream interrupted, finishing with partial text: %s", e)
+                break
+            text += delta
+            now = time.monotonic()
+            if msg is None:
+                msg = await m.answer(_plain_preview(text) or "…", parse_mode=None)
+                last = now
+            elif now - last >= _STREAM_EDIT_EVERY:
+                await _edit_preview(msg, text)
+                last = now
+    finally:
+        with suppress(Exception):
+            await chunks.aclose()
+    if msg is None:
+        return False
+    # тот же порядок, что у непотокового пути: _smart_trim по границе, потом санитайзер
+    final = _sanitize_caption(_smart_trim(text.strip(), _STREAM_LIMIT), limit=_STREAM_LIMIT)
+    await _edit_final(msg, final)
+    return True
+
+async def _edit_final(msg: Message, final: str) -> None:
+    # сообщение уже показано — отсюда ничего не пробрасываем, иначе вызывающий
+    # сочтёт стрим неудачным и пришлёт второй ответ под превью
+    try:
+        try:
+            await msg.edit_text(final, parse_mode="HTML", reply_markup=menu_ai_exit_kb())
+            return
+        except TelegramRetryAfter as e:
+            # после серии правок Telegram часто просит подождать — ждём один раз
+            await asyncio.sleep(e.retry_after)
+            await msg.edit_text(final, parse_mode="HTML", reply_markup=menu_ai_exit_kb())
+            return
+    except TelegramAPIError as e:
+        log.warning("[AI] stream final HTML edit failed: %s", e)
+    with suppress(TelegramAPIError):
+        await msg.edit_text(_plain_preview(final, _STREAM_LIMIT) or "…", parse_mode=None,
+                            reply_markup=menu_ai_exit_kb())
+
 # =========================
 # «печатает…» индикация
 # =========================
@@ -124,6 +223,9 @@ async def _typing_pulse(m: Message, stop_evt: asyncio.Event):
 # OFFLINE KB: простой загрузчик ingested_kb.json и поиск по алиасам
 # =========================
 _KB_CACHE: list[dict] = []
+# плоский индекс имён, строится один раз при загрузке: (имя в нижнем регистре, запись, имя)
+_KB_NAMES: list[tuple[str, dict, str]] = []
+_KB_LOWER: list[str] = []   # только имена, параллельно _KB_NAMES — для rapidfuzz
 _KB_PATHS = [
     Path("data/ingested_kb.json"),
     Path("data/kb/winespecialist.json"),  # если появятся site-packs
@@ -137,23 +239,26 @@ def _load_kb_once():
     for p in _KB_PATHS:
         if p.exists():
             try:
-                data = json.loads(p.read_text(encoding="utf-8"))
+                data = _jloads(p.read_bytes())
                 if isinstance(data, list):
                     out.extend(data)
             except Exception as e:
                 log.warning("[KB] read fail %s: %s", p, e)
     _KB_CACHE = out
+    _KB_NAMES[:] = [(n.lower(), rec, n) for rec in out for n in _all_names(rec)]
+    _KB_LOWER[:] = [x[0] for x in _KB_NAMES]
 
 def _all_names(rec: dict) -> list[str]:
-    names = set()
+    # порядок важен: первое имя — отображаемое (name → brand → title → алиасы)
+    names: dict[str, None] = {}
     for k in ("name", "brand", "title"):
         v = (rec.get(k) or "").strip()
         if v:
-            names.add(v)
+            names[v] = None
     for a in rec.get("aliases") or []:
         vv = (a or "").strip()
         if vv:
-            names.add(vv)
+            names[vv] = None
     return list(names)
 
 def _kb_find_local(query: str) -> Tuple[Optional[dict], Optional[str]]:
@@ -162,26 +267,16 @@ def _kb_find_local(query: str) -> Tuple[Optional[dict], Optional[str]]:
     q = (query or "").strip().lower()
     if not q:
         return None, None
-    best = None
-    best_name = None
-    best_score = 0.0
-
-    for rec in _KB_CACHE:
-        names = _all_names(rec)
-        # точное/вхождение
-        for n in names:
-            nlow = n.lower()
-            if nlow == q or q in nlow or nlow in q:
-                return rec, n  # мгновенно
-        # близость
-        ratio = max([difflib.SequenceMatcher(a=q, b=n.lower()).ratio() for n in names] + [0.0])
-        if ratio > best_score:
-            best_score = ratio
-            best = rec
-            best_name = names[0] if names else None
-
-    if best and best_score >= 0.72:
-        return best, best_name
+    # точное/вхождение — записи в исходном порядке
+    for nlow, rec, n in _KB_NAMES:
+        if nlow == q or q in nlow or nlow in q:
+            return rec, n  # мгновенно
+
+    # близость: C-цикл rapidfuzz, кандидаты ниже порога отсекаются внутри
+    hit = process.extractOne(q, _KB_LOWER, scorer=fuzz.ratio, processor=None, score_cutoff=72)
+    if hit:
+        best = _KB_NAMES[hit[2]][1]
+        return best, _all_names(best)[0]
     return None, None
 
 def _caption_from_rec(rec: dict, display_name: Optional[str] = None) -> str:
@@ -220,8 +315,8 @@ def _photo_from_rec(rec: dict) -> Optional[str]:
 # =========================
 @router.message(F.text == AI_ENTRY_TEXT)
 @router.message(F.text == "/ai")
-async def ai_mode_msg(m: Message):
-    AI_USERS.add(m.from_user.id)
+async def ai_mode_msg(m: Message, state: FSMContext):
+    await state.set_state(AIStates.active)
     await m.answer(
         "AI-режим включён. Работаем <b>только из оффлайн-базы</b> (ingested_kb.json). "
         "Чтобы добавить данные — пополни seed_urls.json и запусти GitHub Actions → Ingest.",
@@ -230,8 +325,8 @@ async def ai_mode_msg(m: Message):
     )
 
 @router.callback_query(F.data == "ai:enter")
-async def ai_mode_cb(cb: CallbackQuery):
-    AI_USERS.add(cb.from_user.id)
+async def ai_mode_cb(cb: CallbackQuery, state: FSMContext):
+    await state.set_state(AIStates.active)
     with suppress(Exception):
         await cb.answer()
     await cb.message.answer(
@@ -243,9 +338,8 @@ async def ai_mode_cb(cb: CallbackQuery):
 @router.message(F.text == AI_EXIT_TEXT)
 @router.message(F.text == "/ai_off")
 @router.callback_query(F.data.in_({"ai:exit", "ai_exit"}))
-async def ai_mode_off(ev):
-    user_id = ev.from_user.id if hasattr(ev, "from_user") else ev.message.from_user.id
-    AI_USERS.discard(user_id)
+async def ai_mode_off(ev, state: FSMContext):
+    await state.clear()
     if isinstance(ev, CallbackQuery):
         with suppress(Exception):
             await ev.answer()
@@ -257,7 +351,7 @@ async def ai_mode_off(ev):
 # =========================
 # Главный AI-хендлер (OFFLINE ONLY)
 # =========================
-@router.message(lambda m: m.from_user.id in AI_USERS and m.text is not None)
+@router.message(AIStates.active, F.text)
 async def handle_ai(m: Message):
     lock = _user_lock(m.from_user.id)
     if lock.locked():
@@ -281,6 +375,15 @@ async def _answer_ai(m: Message, text: str):
     is_sales, outlet, brand_for_sales = detect_sales_intent(q)
     if is_sales:
         html = ""
+        if stream_sales_playbook_with_gemini:
+            streamed = False
+            try:
+                streamed = await _answer_streamed(m, stream_sales_playbook_with_gemini(q, outlet, brand_for_sales))
+            except Exception as e:
+                log.warning("[AI] playbook stream error: %s", e)
+            if streamed:
+                return
+        # стрим не дал ни куска (или его нет) — обычный вызов, и только потом шаблон
         if generate_sales_playbook_with_gemini:
             with suppress(Exception):
                 html = await generate_sales_playbook_with_gemini(q, outlet, brand_for_sales)
@@ -1,16 +1,38 @@
 # app/routers/brands.py
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple, Union
+
 from aiogram import Router, F
-from aiogram.types import Message
+from aiogram.filters import BaseFilter, StateFilter
+from aiogram.types import Message, ReplyKeyboardMarkup
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
 from aiogram.types import KeyboardButton
 
 from app.keyboards.common import categories_kb
 from app.services.brands import by_category, exact_lookup, fuzzy_suggest, get_brand
 from app.services.stats import record_brand_view
-from app.routers.ai_helper import AI_USERS  # важно
 
 router = Router()
 
+@lru_cache(maxsize=256)
+def _names_kb(names: Tuple[str, ...], width: int) -> ReplyKeyboardMarkup:
+    """Клавиатура из имён брендов + «Назад». Ключ — сами имена,
+    так что после перезагрузки каталога старые клавиатуры просто не используются."""
+    kb = ReplyKeyboardBuilder()
+    for n in names:
+        kb.add(KeyboardButton(text=n))
+    kb.add(KeyboardButton(text="Назад"))
+    kb.adjust(width)
+    return kb.as_markup(resize_keyboard=True)
+
+class BrandLookup(BaseFilter):
+    """Один exact_lookup на сообщение; результат уходит в хендлер как brand_name
+    (None — бренд не распознан, тогда хендлер показывает подсказки)."""
+    async def __call__(self, m: Message) -> Union[bool, Dict[str, Any]]:
+        if not m.text:
+            return False
+        return {"brand_name": exact_lookup(m.text)}
+
 @router.message(F.text == "🗂️ Меню брендов")
 async def show_brand_menu(m: Message):
     await m.answer("Выберите категорию:", reply_markup=categories_kb())
@@ -19,10 +41,9 @@ async def show_brand_menu(m: Message):
 async def back(m: Message):
     await m.answer("Окей, выбери категорию снова:", reply_markup=categories_kb())
 
-@router.message(F.text.in_({"🥃 Виски", "🧊 Водка", "🍺 Пиво", "🍷 Вино", "🦌 Ягермейстер"}))
+# StateFilter(None): в AI-режиме (AIStates.active) эти хендлеры не срабатывают
+@router.message(StateFilter(None), F.text.in_({"🥃 Виски", "🧊 Водка", "🍺 Пиво", "🍷 Вино", "🦌 Ягермейстер"}))
 async def pick_category(m: Message):
-    if m.from_user.id in AI_USERS:
-        return
     mapping = {
         "🥃 Виски": "Виски",
         "🧊 Водка": "Водка",
@@ -36,17 +57,15 @@ async def pick_category(m: Message):
         await m.answer("Пока пусто. Выбери другую категорию.", reply_markup=categories_kb()); 
         return
 
-    kb = ReplyKeyboardBuilder()
-    for n in names:
-        kb.add(KeyboardButton(text=n))
-    kb.add(KeyboardButton(text="Назад"))
-    kb.adjust(2)
-    await m.answer(f"Выбери бренд ({cat}):", reply_markup=kb.as_markup(resize_keyboard=True))
+    await m.answer(f"Выбери бренд ({cat}):", reply_markup=_names_kb(tuple(names), 2))
 
-@router.message(lambda m: m.text is not None and exact_lookup(m.text) is not None and m.from_user.id not in AI_USERS)
-async def send_brand_card(m: Message):
-    name = exact_lookup(m.text)
-    item = get_brand(name)
+@router.message(StateFilter(None), BrandLookup())
+async def brand_or_suggest(m: Message, brand_name: Optional[str]):
+    if brand_name is None:
+        await suggest(m)
+        return
+
+    item = get_brand(brand_name)
     if not item:
         await m.answer("Не нашёл бренд. Попробуй ещё раз."); 
         return
@@ -59,15 +78,10 @@ async def send_brand_card(m: Message):
     else:
         await m.answer(item["caption"], parse_mode="HTML")
 
-@router.message(lambda m: m.text is not None and exact_lookup(m.text) is None and m.from_user.id not in AI_USERS)
 async def suggest(m: Message):
     qs = m.text.strip()
     suggestions = fuzzy_suggest(qs, limit=6)
     if not suggestions:
         return
-    kb = ReplyKeyboardBuilder()
-    for name, _ in suggestions:
-        kb.add(KeyboardButton(text=name))
-    kb.add(KeyboardButton(text="Назад"))
-    kb.adjust(1)
-    await m.answer("Возможно, вы искали:", reply_markup=kb.as_markup(resize_keyboard=True))
+    kb = _names_kb(tuple(name for name, _ in suggestions), 1)
+    await m.answer("Возможно, вы искали:", reply_markup=kb)
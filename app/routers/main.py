@@ -1,5 +1,11 @@
 
 import json
+import os
+import asyncio
+from functools import lru_cache
+from typing import Dict, Optional
+
+import aiosqlite
 from aiogram import Router, F
 from aiogram.filters import Command
 from aiogram.types import Message, KeyboardButton
@@ -11,36 +17,83 @@ from app.services.stats import get_stats, format_activity
 ADMIN_IDS = {1294415669}
 router = Router()
 
-USER_INFO_PATH = "user_info.json"
-try:
-    with open(USER_INFO_PATH, "r", encoding="utf-8") as f:
-        USER_INFO = json.load(f)
-except FileNotFoundError:
-    USER_INFO = {}
+USER_INFO_PATH = "user_info.json"   # старый формат, переносится в БД при первом запуске
+USERS_DB_PATH = os.getenv("USERS_DB_PATH", "users.db")
+
+# Кэш профилей в памяти для путей чтения; источник правды — таблица users
+USER_INFO: Dict[str, dict] = {}
+_FIELDS = ("username", "first_name", "last_name", "phone")
+
+_db: Optional[aiosqlite.Connection] = None
+_db_lock = asyncio.Lock()
+
+async def _get_db() -> aiosqlite.Connection:
+    global _db
+    if _db is None:
+        async with _db_lock:
+            if _db is None:
+                conn = await aiosqlite.connect(USERS_DB_PATH)
+                await conn.execute(
+                    "CREATE TABLE IF NOT EXISTS users("
+                    "id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT, phone TEXT)"
+                )
+                await conn.commit()
+                _db = conn
+    return _db
 
-def save_info() -> None:
-    with open(USER_INFO_PATH, "w", encoding="utf-8") as f:
-        json.dump(USER_INFO, f, ensure_ascii=False, indent=2)
+async def _migrate_json(db: aiosqlite.Connection) -> None:
+    try:
+        with open(USER_INFO_PATH, "r", encoding="utf-8") as f:
+            legacy = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return
+    rows = [
+        (int(uid), info.get("username"), info.get("first_name"), info.get("last_name"), info.get("phone"))
+        for uid, info in legacy.items() if str(uid).lstrip("-").isdigit()
+    ]
+    await db.executemany("INSERT OR IGNORE INTO users VALUES(?,?,?,?,?)", rows)
+    await db.commit()
 
-def ensure_user(u) -> None:
+async def init_users() -> None:
+    """Открывает БД, переносит user_info.json (если есть) и прогревает кэш."""
+    db = await _get_db()
+    async with db.execute("SELECT COUNT(*) FROM users") as cur:
+        (count,) = await cur.fetchone()
+    if not count:
+        await _migrate_json(db)
+    async with db.execute("SELECT id, username, first_name, last_name, phone FROM users") as cur:
+        async for row in cur:
+            USER_INFO[str(row[0])] = {k: v for k, v in zip(_FIELDS, row[1:]) if v is not None}
+    display_name.cache_clear()
+
+async def close_users() -> None:
+    global _db
+    if _db is not None:
+        await _db.close()
+        _db = None
+
+async def ensure_user(u) -> None:
     uid = str(u.id)
-    info = USER_INFO.setdefault(uid, {})
-    changed = False
-    if info.get("username") != u.username:
-        info["username"] = u.username
-        changed = True
-    if info.get("first_name") != u.first_name:
-        info["first_name"] = u.first_name
-        changed = True
-    if info.get("last_name") != u.last_name:
-        info["last_name"] = u.last_name
-        changed = True
-    if changed:
-        save_info()
+    info = USER_INFO.get(uid, {})
+    if (info.get("username"), info.get("first_name"), info.get("last_name")) == (u.username, u.first_name, u.last_name):
+        return
+    db = await _get_db()
+    # UPSERT одной строки; телефон не трогаем
+    await db.execute(
+        "INSERT INTO users(id, username, first_name, last_name) VALUES(?,?,?,?) "
+        "ON CONFLICT(id) DO UPDATE SET username=excluded.username, "
+        "first_name=excluded.first_name, last_name=excluded.last_name",
+        (u.id, u.username, u.first_name, u.last_name),
+    )
+    await db.commit()
+    info = dict(info, username=u.username, first_name=u.first_name, last_name=u.last_name)
+    USER_INFO[uid] = info
+    display_name.cache_clear()
 
+@lru_cache(maxsize=1024)
 def display_name(uid: int) -> str:
     info = USER_INFO.get(str(uid), {})
-    name = (info.get("first_name", "") + " " + info.get("last_name", "")).strip()
+    name = ((info.get("first_name") or "") + " " + (info.get("last_name") or "")).strip()
     username = info.get("username")
     if username:
         username = f"@{username}"
@@ -74,7 +127,7 @@ def contact_kb():
 
 @router.message(Command("start"))
 async def start(m: Message):
-    ensure_user(m.from_user)
+    await ensure_user(m.from_user)
     await m.answer("Главное меню", reply_markup=main_menu_kb())
 
 @router.message(F.text == "📊 Моя статистика")
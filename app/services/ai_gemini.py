@@ -1,7 +1,24 @@
 # app/services/ai_gemini.py
 from __future__ import annotations
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, AsyncIterator, Iterator, List, Literal, Optional
 import os, logging, re, json, asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+
+from pydantic import BaseModel
+
+from app.services import llm_cache
+from app.services.brands import exact_lookup, get_brand
+try:
+    from app.services.ai_google import build_caption_from_results
+except Exception:
+    build_caption_from_results = None
+
+try:
+    import orjson
+    _jloads = orjson.loads
+except Exception:
+    _jloads = json.loads
 
 log = logging.getLogger(__name__)
 
@@ -22,20 +39,224 @@ except Exception as e:
     _HAS_TYPES = False
     _HAS_LIB = False
 
+# Ветку SDK выбираем один раз: новый (genai.Client) или старый (GenerativeModel)
+_USE_CLIENT = _HAS_LIB and hasattr(genai, "Client")
+_NO_THINKING = types.ThinkingConfig(thinking_budget=0) if _HAS_TYPES else None
+
 # Ключ и модель
 _GEMINI_KEY = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
 _MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+_MODEL_LIGHT = os.getenv("GEMINI_MODEL_LIGHT", "gemini-2.5-flash-lite")
+
+# Шаблонный текст (playbook) не требует flash — лёгкая модель быстрее на токен
+_TASK_MODELS = {"card": _MODEL, "playbook": _MODEL_LIGHT}
+
+def _choose_model(task: str) -> str:
+    return _TASK_MODELS.get(task, _MODEL)
+
+# Карточка по короткому запросу и небольшому контексту — сначала лёгкая модель;
+# скудный ответ переспрашиваем у основной
+# (порог — доля бюджета _CTX_BUDGET_CHARS: ~4 фрагмента из 10 возможных, иначе лёгкой уходило бы всё)
+_LITE_CTX_CHARS = 2000
+_LITE_QUERY_CHARS = 80
+# сколько карточек закрыла лёгкая модель / ушло на основную / не дождались от лёгкой (без эскалации)
+_CARD_ROUTING = {"lite": 0, "escalated": 0, "lite_failed": 0}
+
+def _card_model(query: Optional[str], context_block: str) -> str:
+    if len(context_block) <= _LITE_CTX_CHARS and len(query or "") < _LITE_QUERY_CHARS:
+        return _MODEL_LIGHT
+    return _choose_model("card")
+
+# Проверяем один раз при импорте (и при смене ключа), а не на каждый запрос
+_CONFIGURED = _HAS_LIB and bool(_GEMINI_KEY)
+_UNCONFIGURED_MSG = "<b>LLM не настроен.</b>"
+if _HAS_LIB and not _GEMINI_KEY:
+    log.warning("GEMINI_API_KEY/GOOGLE_API_KEY not set — Gemini calls are disabled")
 
 def have_gemini() -> bool:
-    return _HAS_LIB and bool(_GEMINI_KEY)
+    return _CONFIGURED
+
+# Клиент/модель создаём один раз на процесс, а не на каждый запрос
+_CLIENT = None
+_OLD_MODELS: Dict[tuple, Any] = {}   # (модель, системный промпт) -> GenerativeModel (старый SDK)
+
+def _get_client():
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = genai.Client(api_key=_GEMINI_KEY)
+    return _CLIENT
+
+def refresh_client(api_key: Optional[str] = None) -> None:
+    """Смена ключа без перезапуска: сбрасываем клиент и модели.
+    Следующий вызов создаст всё заново."""
+    global _CLIENT, _GEMINI_KEY, _CONFIGURED
+    _GEMINI_KEY = api_key or os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
+    _CONFIGURED = _HAS_LIB and bool(_GEMINI_KEY)
+    _CLIENT = None
+    _OLD_MODELS.clear()
+
+def _get_old_model(system: Optional[str] = None, model: str = _MODEL):
+    mdl = _OLD_MODELS.get((model, system))
+    if mdl is None:
+        genai.configure(api_key=_GEMINI_KEY)
+        mdl = genai.GenerativeModel(model, system_instruction=system) if system else genai.GenerativeModel(model)
+        _OLD_MODELS[(model, system)] = mdl
+    return mdl
+
+# Тариф обработки по контексту вызова: пользователь ждёт → priority, фоновые задачи → flex.
+# Передаём только если установленная версия SDK знает поле service_tier.
+Urgency = Literal["interactive", "background"]
+_SERVICE_TIERS = {"interactive": "priority", "background": "flex"}
+_HAS_TIERS = bool(_HAS_TYPES and "service_tier" in getattr(types.GenerateContentConfig, "model_fields", {}))
+
+# Одинаковые запросы, пришедшие одновременно (всплеск по одному бренду), делят один вызов
+_INFLIGHT: Dict[tuple, "asyncio.Task"] = {}
+
+# Пользователь ждёт — зависший вызов не держим: таймаут и один повтор (короче — новый
+# запрос обычно отвечает быстро). Фоновые (flex) ждут в очереди дольше — их не ограничиваем.
+_CALL_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "8"))
+
+async def _call_with_retry(prompt: str, system: Optional[str], urgency: Urgency,
+                           schema: Optional[type], model: str):
+    if urgency != "interactive":
+        return await _call_model(prompt, system, urgency, schema, model)
+    for timeout in (_CALL_TIMEOUT, _CALL_TIMEOUT / 2):
+        try:
+            return await asyncio.wait_for(_call_model(prompt, system, urgency, schema, model), timeout)
+        except asyncio.TimeoutError:
+            log.warning("Gemini timeout after %ss (%s)", timeout, model)
+    raise asyncio.TimeoutError(f"Gemini {model} did not answer")
+
+async def _generate(prompt: str, system: Optional[str] = None, urgency: Urgency = "interactive",
+                    schema: Optional[type] = None, model: str = _MODEL):
+    key = (model, system, prompt, urgency, schema)
+    task = _INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_call_with_retry(prompt, system, urgency, schema, model))
+        _INFLIGHT[key] = task
+        task.add_done_callback(lambda _t, k=key: _INFLIGHT.pop(k, None))
+    # shield: отмена одного ожидающего не отменяет запрос для остальных
+    return await asyncio.shield(task)
+
+def _new_config(system: Optional[str], urgency: Urgency, schema: Optional[type]):
+    cfg: Dict[str, Any] = {"thinking_config": _NO_THINKING}
+    if _HAS_TIERS:
+        cfg["service_tier"] = _SERVICE_TIERS[urgency]
+    if schema is not None:
+        cfg["response_mime_type"] = "application/json"
+        cfg["response_schema"] = schema
+    if system:
+        # статический префикс отдельно — сервер переиспользует его неявным кэшем
+        cfg["system_instruction"] = system
+    return types.GenerateContentConfig(**cfg)
+
+async def _call_model(prompt: str, system: Optional[str] = None, urgency: Urgency = "interactive",
+                      schema: Optional[type] = None, model: str = _MODEL):
+    """Вызов модели через нативный async API SDK — без пула потоков.
+    system — статический префикс: уходит отдельно (system_instruction),
+    чтобы сервер переиспользовал его между запросами.
+    schema — ответ строго JSON по этой модели (JSON mode + response_schema);
+    старый SDK получает только JSON mode.
+    Рассуждения (thinking) выключены для всех путей: задачи шаблонные."""
+    if _USE_CLIENT:
+        client = _get_client()
+        if _HAS_TYPES:
+            cfg = _new_config(system, urgency, schema)
+            return await _client_generate(client, model=model, contents=prompt, config=cfg)
+        contents = [system, prompt] if system else prompt
+        return await _client_generate(client, model=model, contents=contents)
+    gen_cfg = {"response_mime_type": "application/json"} if schema is not None else None
+    mdl = _get_old_model(system, model)
+    if hasattr(mdl, "generate_content_async"):
+        return await mdl.generate_content_async(prompt, generation_config=gen_cfg)
+    return await _run_blocking(mdl.generate_content, prompt, generation_config=gen_cfg)
+
+async def _bounded_chunks(stream, timeout: Optional[float]) -> AsyncIterator[str]:
+    # ждём каждый кусок не дольше timeout: зависший стрим — такая же ошибка, как у _call_with_retry
+    it = stream.__aiter__()
+    while True:
+        try:
+            chunk = await (asyncio.wait_for(it.__anext__(), timeout) if timeout else it.__anext__())
+        except StopAsyncIteration:
+            return
+        if chunk.text:
+            yield chunk.text
+
+async def _stream_model(prompt: str, system: Optional[str] = None,
+                        urgency: Urgency = "interactive", model: str = _MODEL) -> AsyncIterator[str]:
+    """То же, что _call_model, но отдаёт текст кусками по мере генерации.
+    Если SDK не умеет async-стрим — один кусок целиком.
+    Для interactive открытие стрима и каждый следующий кусок ограничены _CALL_TIMEOUT:
+    при зависании — asyncio.TimeoutError, и вызывающий уходит на обычный путь."""
+    timeout = _CALL_TIMEOUT if urgency == "interactive" else None
+    if _USE_CLIENT and _HAS_TYPES and getattr(_get_client(), "aio", None) is not None:
+        client = _get_client()
+        cfg = _new_config(system, urgency, None)
+        stream = await asyncio.wait_for(
+            client.aio.models.generate_content_stream(model=model, contents=prompt, config=cfg), timeout)
+        async for text in _bounded_chunks(stream, timeout):
+            yield text
+        return
+    if not _USE_CLIENT:
+        mdl = _get_old_model(system, model)
+        if hasattr(mdl, "generate_content_async"):
+            resp = await asyncio.wait_for(mdl.generate_content_async(prompt, stream=True), timeout)
+            async for text in _bounded_chunks(resp, timeout):
+                yield text
+            return
+    resp = await _generate(prompt, system=system, urgency=urgency, model=model)
+    text = getattr(resp, "text", "") or ""
+    if text:
+        yield text
+
+def _client_generate(client, **kw):
+    # нативный async-клиент (client.aio); в поток уходим только на версиях SDK без него
+    aio = getattr(client, "aio", None)
+    if aio is not None:
+        return aio.models.generate_content(**kw)
+    return _run_blocking(client.models.generate_content, **kw)
+
+# Свой пул под блокирующий SDK (I/O, а не CPU — потоков больше, чем у пула по умолчанию).
+# Очередь ограничена: при перегрузке сразу ошибка, а не бесконечное ожидание.
+_POOL_SIZE = int(os.getenv("GEMINI_POOL", "32"))
+_GEMINI_EXEC = ThreadPoolExecutor(max_workers=_POOL_SIZE, thread_name_prefix="gemini")
+_GEMINI_SLOTS = asyncio.Semaphore(_POOL_SIZE * 2)   # в работе + столько же в очереди
+
+class GeminiBusy(RuntimeError):
+    pass
+
+async def _run_blocking(fn, *args, **kwargs):
+    if _GEMINI_SLOTS.locked():
+        raise GeminiBusy("Gemini thread pool is saturated")
+    async with _GEMINI_SLOTS:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_GEMINI_EXEC, partial(fn, *args, **kwargs))
+
+async def warmup() -> None:
+    """Прогрев при старте: TCP+TLS к Gemini поднимаем заранее (дешёвый list моделей),
+    чтобы рукопожатие не легло на первый запрос пользователя."""
+    if not _CONFIGURED:
+        return
+    try:
+        if _USE_CLIENT:
+            client = _get_client()
+            aio = getattr(client, "aio", None)
+            if aio is not None:
+                await aio.models.list()
+            else:
+                await _run_blocking(lambda: next(iter(client.models.list()), None))
+        else:
+            genai.configure(api_key=_GEMINI_KEY)
+            await _run_blocking(lambda: next(iter(genai.list_models()), None))
+    except Exception as e:
+        log.debug("Gemini warmup failed: %s", e)
 
 # ---------- СИСТЕМНЫЕ ПРОМПТЫ ----------
 # 1) Для карточек брендов (СТРОГО JSON по схеме → потом рендерим в HTML)
 _SYSTEM_JSON = (
-    "Ты — эксперт по алкогольным брендам и продукту.\n"
-    "Опирайся ТОЛЬКО на переданные источники (RAG). Если факта нет — ставь null.\n"
-    "Верни СТРОГО ОДИН JSON-объект без префиксов/суффиксов/Markdown/HTML.\n"
-    "Схема JSON:\n"
+    "Ты — эксперт по алкогольным брендам.\n"
+    "Опирайся ТОЛЬКО на переданные источники. Нет факта — null.\n"
+    "Верни один JSON-объект по схеме:\n"
     "{\n"
     '  "name": string,\n'
     '  "basics": {"category": string|null, "country": string|null, "abv": string|null},\n'
@@ -47,7 +268,7 @@ _SYSTEM_JSON = (
     '  "sales_script": string[]|null,\n'
     '  "sources": string[]|null\n'
     "}\n"
-    "Требования: русский язык, никаких сравнений/оценок, не выдумывай.\n"
+    "Русский язык, без сравнений и оценок, не выдумывай.\n"
 )
 
 # 2) Для playbook “торгового представителя” (НЕ JSON, сразу HTML)
@@ -69,61 +290,202 @@ _SYSTEM_TRADE = (
 )
 
 # ---------- Утилиты ----------
-_JSON_RE = re.compile(r"\{.*\}", re.S)
-
-def _extract_json(text: str) -> Dict[str, Any]:
+# Схема карточки для response_schema (поля без значений по умолчанию — так их принимает SDK;
+# отсутствующие факты модель возвращает как null)
+class _Basics(BaseModel):
+    category: Optional[str]
+    country: Optional[str]
+    abv: Optional[str]
+
+class BrandCard(BaseModel):
+    name: str
+    basics: _Basics
+    taste: Optional[str]
+    serve: Optional[str]
+    pairing: Optional[str]
+    cocktails: Optional[List[str]]
+    facts: Optional[List[str]]
+    sales_script: Optional[List[str]]
+    sources: Optional[List[str]]
+
+def _find_json_object(text: str) -> Optional[str]:
+    """Первый сбалансированный {...} за один проход (строки и экранирование учитываются)."""
+    depth, start, in_str, escape = 0, -1, False, False
+    for i, ch in enumerate(text):
+        if in_str:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = depth > 0
+        elif ch == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif ch == "}" and depth:
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+def _unfence(text: str) -> Optional[str]:
+    """Тело ```json … ``` — срезами строки, без сканера; None, если это не объект в ограде."""
+    s = text.strip()
+    if not s.startswith("```"):
+        return None
+    s = s[3:]
+    end = s.rfind("```")
+    if end >= 0:
+        s = s[:end]
+    if s[:4].lower() == "json":
+        s = s[4:]
+    s = s.strip()
+    return s if s.startswith("{") and s.endswith("}") else None
+
+# типографские кавычки → обычные: одна таблица, один проход по строке
+_SMART_QUOTES = str.maketrans({"\u201c": '"', "\u201d": '"', "\u00ab": '"', "\u00bb": '"'})
+
+def _parse_json(text: str) -> Dict[str, Any]:
+    # JSON mode: обычно ответ — ровно JSON-объект; сканер — только если модель
+    # всё же обернула его (```json …```, текст вокруг — бывает на старом SDK)
     if not text:
         return {}
-    m = _JSON_RE.search(text)
-    if not m:
-        return {}
-    raw = m.group(0)
     try:
-        return json.loads(raw)
-    except Exception:
-        # типографские кавычки → обычные
-        raw = (raw
-               .replace("\u201c", '"').replace("\u201d", '"')
-               .replace("\u00ab", '"').replace("\u00bb", '"'))
+        data = _jloads(text)
+    except ValueError:   # orjson.JSONDecodeError — тоже ValueError
+        fenced = _unfence(text)
+        if fenced:
+            try:
+                data = _jloads(fenced)
+                return data if isinstance(data, dict) else {}
+            except ValueError:
+                pass
+        # старый SDK без response_schema иногда ставит «ёлочки»/“лапки” вместо кавычек
+        obj = _find_json_object(text)
         try:
-            return json.loads(raw)
-        except Exception:
-            return {}
-
-def _pack_context(results_or_chunks: Any) -> tuple[str, List[str]]:
+            data = _jloads(obj) if obj else {}
+        except ValueError:
+            try:
+                data = _jloads(obj.translate(_SMART_QUOTES))
+            except ValueError:
+                return {}
+    return data if isinstance(data, dict) else {}
+
+# Шаблоны динамической части промптов — собираются один раз при импорте
+_CTX_ROW = "[{0}] {1}\n{2}".format          # номер, url, текст
+_CTX_ROW_NO_URL = "[{0}]\n{1}".format
+_CARD_PROMPT = (
+    "Пользовательский запрос:\n{query}"
+    "\n\nДОСТУПНЫЕ ИСТОЧНИКИ (используй только это, придумывать запрещено):\n{context}"
+    "\n\nВЫВЕДИ ТОЛЬКО ОДИН JSON-ОБЪЕКТ СО СХЕМОЙ ВЫШЕ."
+).format
+_PLAYBOOK_PROMPT = (
+    "Запрос: {query}\nКанал/место: {outlet}\nБренд/категория: {brand}"
+    "\nОтвет дай строго в HTML без лишних вступлений."
+).format
+
+# Ужатие контекста: меньше входных токенов — короче prefill и дешевле вызов
+_CTX_MAX_ITEMS = 10
+_CTX_ITEM_CHARS = 500
+_CTX_BUDGET_CHARS = 6000   # ≈ 2000 токенов на весь блок источников
+_JUNK_RE = re.compile(
+    r"[^.!?\n]*(?:cookie|newsletter|subscribe|подпис\w* на рассылк|политик\w* конфиденциальности)[^.!?\n]*[.!?]?",
+    re.I,
+)
+_WS_RE = re.compile(r"\s+")
+
+def _query_anchor(query: Optional[str]) -> str:
+    """Первое значимое слово запроса — вокруг него в источниках и лежат факты о бренде."""
+    return next((w for w in (query or "").lower().split() if len(w) >= 3), "")
+
+def _clean_snippet(text: str, anchor: str = "") -> str:
+    text = _WS_RE.sub(" ", _JUNK_RE.sub(" ", text or "")).strip()
+    if len(text) > _CTX_ITEM_CHARS:
+        # длинный фрагмент: окно вокруг упоминания запроса, а не всегда начало текста
+        start = 0
+        pos = text.lower().find(anchor) if anchor else -1
+        if pos > _CTX_ITEM_CHARS // 3:
+            start = text.find(" ", min(pos - _CTX_ITEM_CHARS // 3, len(text) - _CTX_ITEM_CHARS)) + 1
+        end = start + _CTX_ITEM_CHARS
+        tail = text[start:] if end >= len(text) else text[start:end].rsplit(" ", 1)[0] + "…"
+        text = ("…" if start else "") + tail
+    return text
+
+def _pack_context(results_or_chunks: Any, query: Optional[str] = None) -> tuple[str, List[str]]:
     """
     Возвращает (текстовый блок контекста, список источников-url)
     Поддерживает:
       - KB-чанки: [{'text':..., 'url':..., 'brand':...}, ...]
       - CSE-результаты: {'results': [{'name','snippet','url'}, ...]}
+    Дубли (тот же url + начало текста) выкидываем, мусор (cookie/подписки) режем,
+    каждый фрагмент ≤ _CTX_ITEM_CHARS (окно вокруг слова из query), весь блок ≤ _CTX_BUDGET_CHARS.
     """
-    urls: List[str] = []
     if isinstance(results_or_chunks, list) and results_or_chunks and isinstance(results_or_chunks[0], dict):
-        # KB чанки
-        lines = []
-        for i, ch in enumerate(results_or_chunks[:10], 1):
-            text = (ch.get("text") or "").strip()
-            url = (ch.get("url") or "").strip()
-            if url:
-                urls.append(url)
-                lines.append(f"[{i}] {url}\n{text}")
-            else:
-                lines.append(f"[{i}]\n{text}")
-        return ("\n\n".join(lines) if lines else "нет данных"), urls
-
-    if isinstance(results_or_chunks, dict) and "results" in results_or_chunks:
-        lines = []
-        for i, r in enumerate(results_or_chunks.get("results", [])[:10], 1):
-            name = (r.get("name") or "").strip()
-            snip = (r.get("snippet") or "").strip()
-            url = (r.get("url") or "").strip()
-            if url:
+        rows = tuple(((ch.get("url") or "").strip(), ch.get("text") or "") for ch in results_or_chunks)
+    elif isinstance(results_or_chunks, dict) and "results" in results_or_chunks:
+        rows = tuple(((r.get("url") or "").strip(), r.get("snippet") or r.get("name") or "")
+                     for r in results_or_chunks.get("results", []))
+    else:
+        return "нет данных", []
+    block, urls = _pack_rows(rows, _query_anchor(query))
+    return block, list(urls)
+
+@lru_cache(maxsize=256)
+def _pack_rows(rows: tuple, anchor: str = "") -> tuple[str, tuple]:
+    # одни и те же результаты поиска (карточка, повтор запроса) чистим и склеиваем один раз
+    urls: List[str] = []
+    lines: List[str] = []
+    seen = set()
+    budget = _CTX_BUDGET_CHARS
+    for url, raw in rows:
+        text = _clean_snippet(raw, anchor)
+        key = (url, text[:200].lower())
+        if key in seen or not (url or text):
+            continue
+        seen.add(key)
+        if len(text) > budget:
+            break
+        budget -= len(text)
+        i = len(lines) + 1
+        if url:
+            if url not in urls:
                 urls.append(url)
-            payload = snip or name or ""
-            lines.append(f"[{i}] {url}\n{payload}")
-        return ("\n\n".join(lines) if lines else "нет данных"), urls
+            lines.append(_CTX_ROW(i, url, text))
+        else:
+            lines.append(_CTX_ROW_NO_URL(i, text))
+        if len(lines) >= _CTX_MAX_ITEMS:
+            break
+    return ("\n\n".join(lines) if lines else "нет данных"), tuple(urls)
+
+# канонический ключ → варианты, которые встречаются в ответах модели
+# (как цепочка `a or b or c`: первый непустой, иначе значение последнего)
+_ALIASES: Dict[str, tuple] = {
+    "name": ("name", "название", "бренд"),
+    "category": ("категория",),
+    "country": ("страна",),
+    "abv": ("крепость",),
+    "taste": ("taste", "дегустационные_ноты", "ноты"),
+    "serve": ("serve", "подача"),
+    "pairing": ("pairing", "гастросочетания", "сочетания"),
+    "cocktails": ("cocktails", "коктейли"),
+    "facts": ("facts", "производство", "факты"),
+    "sales_script": ("sales_script", "как_продавать", "скрипт"),
+    "sources": ("sources", "источники"),
+}
+
+def _pick(d: Dict[str, Any], key: str) -> Any:
+    v = None
+    for k in _ALIASES[key]:
+        v = d.get(k)
+        if v:
+            break
+    return v
 
-    return "нет данных", urls
+def _as_list(x: Any) -> Optional[List[Any]]:
+    return x if x is None or isinstance(x, list) else [str(x)]
 
 def _normalize_schema(d: Dict[str, Any]) -> Dict[str, Any]:
     """Приводим возможные русские ключи к ожидаемой схеме."""
@@ -132,61 +494,48 @@ def _normalize_schema(d: Dict[str, Any]) -> Dict[str, Any]:
     if "name" in d and "basics" in d:
         return d
 
-    name = d.get("name") or d.get("название") or d.get("бренд") or ""
-    basics = d.get("basics") if isinstance(d.get("basics"), dict) else {}
-    category = (basics.get("category") if basics else None) or d.get("категория")
-    country  = (basics.get("country")  if basics else None) or d.get("страна")
-    abv      = (basics.get("abv")      if basics else None) or d.get("крепость")
-
-    taste    = d.get("taste") or d.get("дегустационные_ноты") or d.get("ноты")
-    serve    = d.get("serve") or d.get("подача")
-    pairing  = d.get("pairing") or d.get("гастросочетания") or d.get("сочетания")
-
-    cocktails = d.get("cocktails") or d.get("коктейли")
-    if isinstance(cocktails, str):
-        cocktails = [cocktails]
-
-    facts = d.get("facts") or d.get("производство") or d.get("факты")
-    if isinstance(facts, str):
-        facts = [facts]
-
-    sales = d.get("sales_script") or d.get("как_продавать") or d.get("скрипт")
-    if isinstance(sales, str):
-        sales = [sales]
-
-    sources = d.get("sources") or d.get("источники")
-
+    basics = d.get("basics")
+    basics = basics if isinstance(basics, dict) else {}
+    cocktails = _pick(d, "cocktails")
     return {
-        "name": name,
-        "basics": {"category": category, "country": country, "abv": abv},
-        "taste": taste,
-        "serve": serve,
-        "pairing": pairing,
-        "cocktails": cocktails if isinstance(cocktails, list) else None,
-        "facts": facts if isinstance(facts, list) else (None if facts is None else [str(facts)]),
-        "sales_script": sales if isinstance(sales, list) else (None if sales is None else [str(sales)]),
-        "sources": sources if isinstance(sources, list) else (None if sources is None else [str(sources)]),
+        "name": _pick(d, "name") or "",
+        # basics.* приоритетнее русских ключей верхнего уровня
+        "basics": {k: basics.get(k) or _pick(d, k) for k in ("category", "country", "abv")},
+        "taste": _pick(d, "taste"),
+        "serve": _pick(d, "serve"),
+        "pairing": _pick(d, "pairing"),
+        # коктейли — только строка или список; прочее (число, объект) отбрасываем
+        "cocktails": _as_list(cocktails) if isinstance(cocktails, (list, str)) else None,
+        "facts": _as_list(_pick(d, "facts")),
+        "sales_script": _as_list(_pick(d, "sales_script")),
+        "sources": _as_list(_pick(d, "sources")),
     }
 
 def _is_sparse(d: Dict[str, Any]) -> bool:
     """Почти пустой ответ?"""
     if not isinstance(d, dict):
         return True
+    # генераторы останавливаются на первом заполненном поле
+    if any(d.get(k) for k in ("taste", "facts", "serve", "pairing")):
+        return False
     b = d.get("basics") or {}
-    has_basics = any([b.get("category"), b.get("country"), b.get("abv")])
-    has_content = any([d.get("taste"), d.get("facts"), d.get("serve"), d.get("pairing")])
-    return not (has_basics or has_content)
+    return not any(b.get(k) for k in ("category", "country", "abv"))
+
+# разделители по приоритету и сколько символов разделителя оставить
+_TRIM_SEPS = tuple((sep, 0 if sep in ("\n•", "\n") else len(sep.strip()))
+                   for sep in ("\n•", ".</", ". ", "\n", "; ", "— ", ", "))
 
 def _smart_trim(text: str, limit: int) -> str:
     """Аккуратное укорачивание под лимит: режем по ближайшему разделителю."""
     if len(text) <= limit:
         return text
     cut = text[:limit]
-    # ищем удобную границу
-    for sep in ("\n•", ".</", ". ", "\n", "; ", "— ", ", "):
-        i = cut.rfind(sep)
-        if i >= 0 and i >= limit * 0.6:
-            cut = cut[:i + (0 if sep in ("\n•", "\n") else len(sep.strip()))]
+    # ищем удобную границу — только в хвосте (последние 40%), раньше резать не будем
+    lo = -(-limit * 3 // 5)   # ceil(limit * 0.6)
+    for sep, keep in _TRIM_SEPS:
+        i = cut.rfind(sep, lo)
+        if i >= 0:
+            cut = cut[:i + keep]
             break
     cut = cut.rstrip()
     if not cut.endswith("…"):
@@ -194,105 +543,128 @@ def _smart_trim(text: str, limit: int) -> str:
     return cut
 
 # ---------- РЕНДЕР КОМПАКТНОГО HTML ----------
-def _render_card_html(d: Dict[str, Any], limit: int = 950) -> str:
-    def esc(s: str) -> str:
-        return (s or "").strip()
+def _esc(s: str) -> str:
+    return (s or "").strip()
 
-    name = esc(d.get("name", ""))
-    b = d.get("basics", {}) or {}
-    basics = []
-    if b.get("category"): basics.append(f"Категория: {esc(b.get('category'))}")
-    if b.get("country"):  basics.append(f"Страна: {esc(b.get('country'))}")
-    if b.get("abv"):      basics.append(f"Крепость: {esc(b.get('abv'))}")
+_BASICS_LABELS = (("category", "Категория: "), ("country", "Страна: "), ("abv", "Крепость: "))
+_TEXT_FIELDS = (("taste", "• Профиль: "), ("serve", "• Подача: "), ("pairing", "• Сочетания: "))
 
-    lines: List[str] = []
+def _card_lines(d: Dict[str, Any]) -> Iterator[str]:
+    """Строки карточки по порядку; генератор — чтобы рендер мог остановиться на лимите."""
+    name = _esc(d.get("name", ""))
     if name:
-        lines.append(f"<b>{name}</b>")
+        yield f"<b>{name}</b>"
+    b = d.get("basics", {}) or {}
+    # каждое поле достаём и чистим один раз
+    basics = [label + _esc(v) for k, label in _BASICS_LABELS if (v := b.get(k))]
     if basics:
-        lines.append("• " + " | ".join(basics))
-    if d.get("taste"):
-        lines.append("• Профиль: " + esc(d.get("taste")))
-    if d.get("serve"):
-        lines.append("• Подача: " + esc(d.get("serve")))
-    if d.get("pairing"):
-        lines.append("• Сочетания: " + esc(d.get("pairing")))
+        yield "• " + " | ".join(basics)
+    for k, label in _TEXT_FIELDS:
+        if v := d.get(k):
+            yield label + _esc(v)
 
     ckt = d.get("cocktails") or []
     if isinstance(ckt, list) and ckt:
-        lines.append("• Коктейли: " + ", ".join(esc(x) for x in ckt[:2]))
+        yield "• Коктейли: " + ", ".join(_esc(x) for x in ckt[:2])
 
     facts = d.get("facts") or []
     if isinstance(facts, list):
         for f in facts[:3]:
             if f:
-                lines.append("• " + esc(f))
+                yield "• " + _esc(f)
 
     ss = d.get("sales_script") or []
     if ss:
-        lines.append("<b>Скрипт продажи:</b>")
+        yield "<b>Скрипт продажи:</b>"
         for s in ss[:3]:
             if s:
-                lines.append("• " + esc(s))
+                yield "• " + _esc(s)
 
     src = d.get("sources") or []
     if src:
-        tail = " ".join([f"<a href='{esc(u)}'>[{i+1}]</a>" for i, u in enumerate(src[:3])])
-        lines.append("Источники: " + tail)
+        yield "Источники: " + " ".join(f"<a href='{_esc(u)}'>[{i}]</a>" for i, u in enumerate(src[:3], 1))
 
+def _render_card_html(d: Dict[str, Any], limit: int = 950) -> str:
+    lines: List[str] = []
+    size = -1   # длина "\n".join(lines)
+    for line in _card_lines(d):
+        lines.append(line)
+        size += len(line) + 1
+        if size - (len(line) - len(line.rstrip())) > limit:
+            break   # дальше всё равно отрежет _smart_trim — не собираем лишнее
     card = "\n".join(lines).strip()
     return _smart_trim(card, limit)
 
-# ---------- Основной генератор карточки ----------
-async def generate_caption_with_gemini(query: str, results_or_chunks: Optional[Any]) -> str:
-    """
-    Просим у модели СТРОГО JSON по нужной схеме; если ответ «скудный» — фолбэк из веб-результатов.
-    """
-    if not have_gemini():
-        return "<b>LLM не настроен.</b>"
-
-    context_block, ctx_urls = _pack_context(results_or_chunks)
-    prompt = (
-        _SYSTEM_JSON
-        + "\n\nПользовательский запрос:\n" + (query or "")
-        + "\n\nДОСТУПНЫЕ ИСТОЧНИКИ (используй только это, придумывать запрещено):\n" + context_block
-        + "\n\nВЫВЕДИ ТОЛЬКО ОДИН JSON-ОБЪЕКТ СО СХЕМОЙ ВЫШЕ."
-    )
-
-    def _call_new():
-        client = genai.Client(api_key=_GEMINI_KEY)
-        if _HAS_TYPES:
-            cfg = types.GenerateContentConfig(thinking_config=types.ThinkingConfig(thinking_budget=0))
-            return client.models.generate_content(model=_MODEL, contents=prompt, config=cfg)
-        else:
-            return client.models.generate_content(model=_MODEL, contents=prompt)
-
-    def _call_old():
-        genai.configure(api_key=_GEMINI_KEY)
-        mdl = genai.GenerativeModel(_MODEL)
-        return mdl.generate_content(prompt)
+def _canned_card(query: Optional[str]) -> Optional[str]:
+    name = exact_lookup(query or "")
+    card = get_brand(name) if name else None
+    return card["caption"] if card else None
 
+async def _card_json(prompt: str, urgency: Urgency, model: str) -> Optional[Dict[str, Any]]:
+    """None — модель не ответила (таймаут/ошибка); {} — ответила, но JSON не разобрался."""
     try:
-        if hasattr(genai, "Client"):
-            resp = await asyncio.to_thread(_call_new)
-        else:
-            resp = await asyncio.to_thread(_call_old)
+        resp = await _generate(prompt, system=_SYSTEM_JSON, urgency=urgency, schema=BrandCard, model=model)
         raw = (getattr(resp, "text", "") or "").strip()
+        usage = getattr(resp, "usage_metadata", None)
+        if usage is not None:
+            log.debug("Gemini card prompt tokens: %s", getattr(usage, "prompt_token_count", "?"))
     except Exception as e:
-        log.warning("Gemini generation error: %s", e)
-        raw = ""
+        log.warning("Gemini generation error (%s): %s", model, e)
+        return None
+    data = _parse_json(raw)
+    return _normalize_schema(data) if data else {}
 
-    data = _extract_json(raw)
-    data = _normalize_schema(data) if data else {}
+# ---------- Основной генератор карточки ----------
+async def generate_caption_with_gemini(query: str, results_or_chunks: Optional[Any],
+                                       urgency: Urgency = "interactive") -> str:
+    """
+    Просим у модели СТРОГО JSON по нужной схеме; если ответ «скудный» — фолбэк из веб-результатов.
+    urgency="background" — для прогрева/предрасчёта (дешевле, медленнее).
+    """
+    if not _CONFIGURED:
+        return _UNCONFIGURED_MSG
+
+    context_block, ctx_urls = _pack_context(results_or_chunks, query)
+    if not ctx_urls and context_block == "нет данных":
+        # источников нет — модели нечего добавить; бренд из каталога отдаём готовой карточкой
+        canned = _canned_card(query)
+        if canned:
+            return canned
+    # статическая часть (_SYSTEM_JSON) передаётся отдельно — см. _generate
+    prompt = _CARD_PROMPT(query=query or "", context=context_block)
+
+    # повторные/почти одинаковые запросы по тем же источникам отдаём из кэша;
+    # пространство — по модели маршрута (ответ мог дать и эскалированный вызов)
+    model = _card_model(query, context_block)
+    ns = "card:" + model
+    sem_key = (query or "").lower().strip() + "|" + "|".join(sorted(ctx_urls))
+    cached = await llm_cache.lookup(ns, _SYSTEM_JSON + prompt, sem_key)
+    if cached:
+        return cached
+
+    data = await _card_json(prompt, urgency, model)
+    strong = _choose_model("card")
+    if model != strong:
+        if data is None:
+            # лёгкая не ответила за свой бюджет — второй полный бюджет основной не даём,
+            # сразу фолбэк из веб-результатов
+            _CARD_ROUTING["lite_failed"] += 1
+            log.debug("Gemini card: %s failed, no escalation (routing: %s)", model, _CARD_ROUTING)
+        elif _is_sparse(data):
+            _CARD_ROUTING["escalated"] += 1
+            data = await _card_json(prompt, urgency, strong)
+        else:
+            _CARD_ROUTING["lite"] += 1
+            log.debug("Gemini card served by %s (routing: %s)", model, _CARD_ROUTING)
+    data = data or {}
 
     # если JSON пустой/скудный — фолбэк из веб-результатов (тот же формат карточки)
-    if _is_sparse(data):
-        try:
-            # лёгкий фолбэк: соберём короткую сводку из сниппетов CSE
-            from app.services.ai_google import build_caption_from_results
-            if isinstance(results_or_chunks, dict) and results_or_chunks.get("results"):
-                return _smart_trim(build_caption_from_results(query, results_or_chunks), 950)
-        except Exception as e:
-            log.warning("Google fallback failed: %s", e)
+    sparse = _is_sparse(data)
+    if sparse:
+        # лёгкий фолбэк: короткая сводка из сниппетов CSE — чистый CPU по уже
+        # полученным результатам, так что гонять его параллельно с моделью незачем
+        if build_caption_from_results and isinstance(results_or_chunks, dict) and results_or_chunks.get("results"):
+            return _smart_trim(build_caption_from_results(query, results_or_chunks), 950)
         # минимальная заглушка
         data = {
             "name": query,
@@ -304,40 +676,78 @@ async def generate_caption_with_gemini(query: str, results_or_chunks: Optional[A
     if not data.get("sources") and ctx_urls:
         data["sources"] = ctx_urls[:3]
 
-    return _render_card_html(data, limit=950)
+    html = _render_card_html(data, limit=950)
+    if not sparse:   # заглушки не кэшируем — следующий запрос пусть попробует снова
+        await llm_cache.store(ns, _SYSTEM_JSON + prompt, html, sem_key)
+    return html
 
 # ---------- Тренерский «playbook» (Торговый представитель) ----------
-async def generate_sales_playbook_with_gemini(query: str, outlet: str | None, brand: str | None) -> str:
+# playbook кэшируем только по точному промпту: «похожий» запрос легко оказывается
+# про другую точку или бренд, а ответ для них — другой
+def _playbook_cache_ns(model: str) -> str:
+    return "playbook:" + model
+
+async def generate_sales_playbook_with_gemini(query: str, outlet: str | None, brand: str | None,
+                                              urgency: Urgency = "interactive") -> str:
     """
     Короткий разбор “как продвигать” — от лица торгового представителя (все каналы).
     Возвращает HTML для Telegram. Ограничиваем длину, чтобы не резалось.
     """
-    if not have_gemini():
-        return "LLM не настроен."
+    if not _CONFIGURED:
+        return _UNCONFIGURED_MSG
 
-    topic = f"Запрос: {query}\nКанал/место: {outlet or 'не указано'}\nБренд/категория: {brand or 'не указан'}"
-    prompt = _SYSTEM_TRADE + "\n\n" + topic + "\nОтвет дай строго в HTML без лишних вступлений."
-
-    def _call_new():
-        client = genai.Client(api_key=_GEMINI_KEY)
-        if _HAS_TYPES:
-            cfg = types.GenerateContentConfig(thinking_config=types.ThinkingConfig(thinking_budget=0))
-            return client.models.generate_content(model=_MODEL, contents=prompt, config=cfg)
-        else:
-            return client.models.generate_content(model=_MODEL, contents=prompt)
-
-    def _call_old():
-        genai.configure(api_key=_GEMINI_KEY)
-        mdl = genai.GenerativeModel(_MODEL)
-        return mdl.generate_content(prompt)
+    prompt = _PLAYBOOK_PROMPT(query=query, outlet=outlet or "не указано", brand=brand or "не указан")
+    model = _choose_model("playbook")
+    ns = _playbook_cache_ns(model)
+    cached = await llm_cache.lookup(ns, _SYSTEM_TRADE + prompt)
+    if cached:
+        return _smart_trim(cached, 950)
 
     try:
-        if hasattr(genai, "Client"):
-            resp = await asyncio.to_thread(_call_new)
-        else:
-            resp = await asyncio.to_thread(_call_old)
-        html = (getattr(resp, "text", "") or "Не удалось сгенерировать ответ.").strip()
-        return _smart_trim(html, 950)
+        resp = await _generate(prompt, system=_SYSTEM_TRADE, urgency=urgency, model=model)
+        html = (getattr(resp, "text", "") or "").strip()
     except Exception as e:
         log.warning("Gemini playbook error: %s", e)
+        html = ""
+    if not html:
         return "Не удалось сгенерировать ответ."
+    # в кэше — полный текст: его же отдаёт потоковая версия
+    await llm_cache.store(ns, _SYSTEM_TRADE + prompt, html)
+    return _smart_trim(html, 950)
+
+async def stream_sales_playbook_with_gemini(query: str, outlet: str | None, brand: str | None,
+                                            urgency: Urgency = "interactive") -> AsyncIterator[str]:
+    """Потоковая версия playbook: куски HTML по мере генерации (первый — через доли секунды).
+    Ничего не отдаёт, если LLM не настроен или вызов упал до первого куска."""
+    if not _CONFIGURED:
+        return
+    prompt = _PLAYBOOK_PROMPT(query=query, outlet=outlet or "не указано", brand=brand or "не указан")
+    model = _choose_model("playbook")
+    ns = _playbook_cache_ns(model)
+    cached = await llm_cache.lookup(ns, _SYSTEM_TRADE + prompt)
+    if cached:
+        yield cached
+        return
+    parts: List[str] = []
+    try:
+        async for delta in _stream_model(prompt, system=_SYSTEM_TRADE, urgency=urgency, model=model):
+            parts.append(delta)
+            yield delta
+    except Exception as e:
+        log.warning("Gemini playbook stream error: %s", e)
+        return
+    await llm_cache.store(ns, _SYSTEM_TRADE + prompt, "".join(parts).strip())
+
+# ---------- Карточка + playbook одним вызовом ----------
+_FUSED_SLOTS = asyncio.Semaphore(8)   # не больше 8 пар в работе одновременно
+
+async def generate_card_and_playbook(query: str, results_or_chunks: Optional[Any],
+                                     outlet: str | None, brand: str | None,
+                                     urgency: Urgency = "interactive") -> tuple[str, str]:
+    """Карточка бренда и playbook параллельно через общий клиент: ждём max(t1, t2), а не сумму."""
+    async with _FUSED_SLOTS:
+        card, playbook = await asyncio.gather(
+            generate_caption_with_gemini(query, results_or_chunks, urgency=urgency),
+            generate_sales_playbook_with_gemini(query, outlet, brand, urgency=urgency),
+        )
+    return card, playbook
@@ -1,54 +1,124 @@
 # app/services/ai_google.py
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
+import asyncio
+import html
 import os
-import httpx
+import json
+import aiohttp
+from cachetools import TTLCache
+
+try:
+    import orjson
+    _jloads = orjson.loads
+except Exception:
+    _jloads = json.loads
 
 from app.settings import settings
 
 WEB_URL = "https://www.googleapis.com/customsearch/v1"
 
+# Популярные бренды спрашивают постоянно — держим ответы CSE в памяти:
+# текст — час, картинки меняются редко — сутки
+_TEXT_CACHE: TTLCache = TTLCache(maxsize=2048, ttl=3600)
+_IMG_CACHE: TTLCache = TTLCache(maxsize=2048, ttl=24 * 3600)
+_INFLIGHT: Dict[Tuple, asyncio.Lock] = {}
+_MISS = object()
+
+# Одна сессия aiohttp на процесс (он уже есть — на нём работает aiogram): keep-alive и
+# кэш DNS — без DNS/TCP/TLS на каждый запрос, накладные расходы на запрос ниже, чем у httpx
+_HTTP: Optional[aiohttp.ClientSession] = None
+
 class FetchError(Exception):
     pass
 
-def _get(params: Dict[str, Any]) -> Dict[str, Any]:
+def _http() -> aiohttp.ClientSession:
+    # создаём лениво — сессии нужен запущенный event loop
+    global _HTTP
+    if _HTTP is None or _HTTP.closed:
+        _HTTP = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=20, ttl_dns_cache=600),
+            timeout=aiohttp.ClientTimeout(total=12.0),
+        )
+    return _HTTP
+
+async def close_http() -> None:
+    global _HTTP
+    if _HTTP is not None:
+        await _HTTP.close()
+        _HTTP = None
+
+async def _get(params: Dict[str, Any]) -> Dict[str, Any]:
     key = settings.google_cse_key or os.getenv("GOOGLE_CSE_KEY")
     cx  = settings.google_cse_cx  or os.getenv("GOOGLE_CSE_CX")
     if not key or not cx:
         raise FetchError("GOOGLE_CSE_KEY/GOOGLE_CSE_CX are not configured")
 
-    q = dict(params)
+    q = {k: str(v) for k, v in params.items()}
     q.setdefault("key", key)
     q.setdefault("cx", cx)
 
     try:
-        r = httpx.get(WEB_URL, params=q, timeout=12.0)
-        r.raise_for_status()
-        return r.json()
-    except httpx.HTTPStatusError as e:
-        code = e.response.status_code if e.response is not None else "HTTP"
-        raise FetchError(f"Google CSE error {code}") from e
+        # асинхронный клиент — не блокируем event loop aiogram на время запроса
+        async with _http().get(WEB_URL, params=q) as r:
+            r.raise_for_status()
+            return _jloads(await r.read())
+    except aiohttp.ClientResponseError as e:
+        raise FetchError(f"Google CSE error {e.status}") from e
     except Exception as e:
         raise FetchError(str(e)) from e
 
+def _cache_key(query: str) -> str:
+    return " ".join((query or "").lower().split())
+
+async def _cached(cache: TTLCache, key: Tuple, fetch):
+    """Достаём из кэша; одновременные промахи по одному ключу ждут один запрос."""
+    hit = cache.get(key, _MISS)
+    if hit is not _MISS:
+        return hit
+    lock = _INFLIGHT.setdefault(key, asyncio.Lock())
+    try:
+        async with lock:
+            hit = cache.get(key, _MISS)
+            if hit is not _MISS:
+                return hit
+            value = await fetch()
+            cache[key] = value
+            return value
+    finally:
+        if _INFLIGHT.get(key) is lock and not lock.locked():
+            _INFLIGHT.pop(key, None)
+
+def clear_search_cache() -> None:
+    """Сброс кэша поиска (например, после смены белого списка доменов — фильтры пересобираем)."""
+    global _SITE_FILTER
+    _TEXT_CACHE.clear()
+    _IMG_CACHE.clear()
+    _SITE_FILTER = _build_site_filter()
+
+def _build_site_filter() -> str:
+    doms = [d for d in settings.allowed_domains_list if d]
+    return "(" + " OR ".join([f"site:{d}" for d in doms]) + ")" if doms else ""
+
+# белый список после старта не меняется — хвост "(site:a OR site:b …)" собираем один раз
+_SITE_FILTER = _build_site_filter()
+
 def _with_site_filter(query: str) -> str:
     # жёстко ограничим домены через site:
-    doms = [d for d in settings.allowed_domains_list if d]
-    if not doms:
-        return query
-    sites = " OR ".join([f"site:{d}" for d in doms])
-    return f"{query} ({sites})"
+    return f"{query} {_SITE_FILTER}" if _SITE_FILTER else query
 
-def web_search_brand(query: str, limit: int = 8) -> Dict[str, Any]:
+async def web_search_brand(query: str, limit: int = 8) -> Dict[str, Any]:
     num = min(max(limit, 1), 10)
-    data = _get({
+    return await _cached(_TEXT_CACHE, ("web", _cache_key(query), num), lambda: _web_search(query, num))
+
+async def _web_search(query: str, num: int) -> Dict[str, Any]:
+    data = await _get({
         "q": _with_site_filter(query),
         "num": num,
         "hl": "ru",
         "safe": "active",
     })
-    items = data.get("items") or []
     results: List[Dict[str, str]] = []
-    for it in items:
+    for it in data.get("items") or []:
         results.append({
             "name": it.get("title"),
             "url": it.get("link"),
@@ -58,8 +128,11 @@ def web_search_brand(query: str, limit: int = 8) -> Dict[str, Any]:
         raise FetchError("No results from Google CSE")
     return {"results": results}
 
-def image_search_brand(query: str) -> Optional[Dict[str, Any]]:
-    data = _get({
+async def image_search_brand(query: str) -> Optional[Dict[str, Any]]:
+    return await _cached(_IMG_CACHE, ("img", _cache_key(query)), lambda: _image_search(query))
+
+async def _image_search(query: str) -> Optional[Dict[str, Any]]:
+    data = await _get({
         "q": _with_site_filter(query),
         "num": 5,
         "searchType": "image",
@@ -67,8 +140,7 @@ def image_search_brand(query: str) -> Optional[Dict[str, Any]]:
         "safe": "active",
         "hl": "ru",
     })
-    items = data.get("items") or []
-    for it in items:
+    for it in data.get("items") or []:
         link = it.get("link")
         if link:
             return {
@@ -78,3 +150,37 @@ def image_search_brand(query: str) -> Optional[Dict[str, Any]]:
                 "title": it.get("title"),
             }
     return None
+
+async def web_and_image(query: str, limit: int = 8) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """Текстовый и картиночный поиск параллельно (RTT перекрываются).
+    Ошибка одного запроса не ломает второй — вместо результата вернётся None."""
+    results, img = await asyncio.gather(
+        web_search_brand(query, limit=limit),
+        image_search_brand(query + " бутылка"),
+        return_exceptions=True,
+    )
+    if isinstance(results, BaseException):
+        results = None
+    if isinstance(img, BaseException):
+        img = None
+    return results, img
+
+def build_caption_from_results(query: str, results: Dict[str, Any], limit: int = 3) -> str:
+    """Короткая карточка прямо из сниппетов CSE — фолбэк, когда LLM ответил пусто."""
+    snippets: List[str] = []
+    seen = set()
+    urls: List[str] = []
+    for r in results.get("results") or []:
+        sn = " ".join((r.get("snippet") or "").split())
+        if sn and sn not in seen and len(snippets) < limit:
+            seen.add(sn)
+            snippets.append(sn)
+        url = r.get("url")
+        if url and url not in urls and len(urls) < limit:
+            urls.append(url)
+    lines = [f"<b>{html.escape(query or '')}</b>"]
+    lines += ["• " + html.escape(sn) for sn in snippets]
+    if urls:
+        lines.append("Источники: " + " ".join(
+            f"<a href='{html.escape(u, quote=True)}'>[{i + 1}]</a>" for i, u in enumerate(urls)))
+    return "\n".join(lines)
@@ -1,11 +1,25 @@
-import asyncio
-from typing import Dict, Any, List
-from openai import OpenAI
+from typing import Dict, Any, AsyncIterator, List, Optional
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from app.settings import settings
 
 def have_llm() -> bool:
     return bool(settings.openai_api_key)
 
+# Нативный async-клиент, один на процесс: без пула потоков и без нового клиента на вызов.
+# Свой пул соединений с keep-alive — TLS к api.openai.com поднимаем один раз
+_CLIENT: Optional[AsyncOpenAI] = None
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=4, max_connections=20)
+
+def _get_client() -> AsyncOpenAI:
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = AsyncOpenAI(
+            api_key=settings.openai_api_key,
+            http_client=DefaultAsyncHttpxClient(limits=_HTTP_LIMITS),
+        )
+    return _CLIENT
+
 def _trim_results(results: Dict[str, Any], limit: int = 5) -> List[Dict[str, str]]:
     out = []
     for r in (results.get("results") or [])[:limit]:
@@ -30,9 +44,8 @@ def _build_messages(query: str, web_results: Dict[str, Any], locale: str = "ru")
         {"role": "user", "content": f"Запрос пользователя: {query}\nВеб-результаты: {trimmed}"}
     ]
 
-def _call_openai(messages: list, model: str = "gpt-4o-mini") -> str:
-    client = OpenAI(api_key=settings.openai_api_key)
-    resp = client.chat.completions.create(
+async def _call_openai(messages: list, model: str = "gpt-4o-mini") -> str:
+    resp = await _get_client().chat.completions.create(
         model=model,
         messages=messages,
         temperature=0.3,
@@ -40,7 +53,24 @@ def _call_openai(messages: list, model: str = "gpt-4o-mini") -> str:
     )
     return resp.choices[0].message.content or "Данных недостаточно."
 
+async def _stream_openai(messages: list, model: str = "gpt-4o-mini") -> AsyncIterator[str]:
+    stream = await _get_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0.3,
+        max_tokens=450,
+        stream=True,
+    )
+    async for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            yield delta
+
 async def generate_card_with_llm(query: str, web_results: Dict[str, Any]) -> str:
     messages = _build_messages(query, web_results)
-    # Вынесем блокирующий вызов в поток, чтобы не блокировать event loop
-    return await asyncio.to_thread(_call_openai, messages)
+    return await _call_openai(messages)
+
+async def stream_card_with_llm(query: str, web_results: Dict[str, Any]) -> AsyncIterator[str]:
+    """Та же карточка, но кусками по мере генерации — для постепенного edit_text в Telegram."""
+    async for delta in _stream_openai(_build_messages(query, web_results)):
+        yield delta
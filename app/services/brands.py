@@ -2,19 +2,48 @@
 # Поддержка JSON в виде СПИСКА карточек [{...}, {...}] или словаря {name: {...}}
 from __future__ import annotations
 import json, re
+from bisect import bisect_right
+from heapq import merge
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Any, List, Optional, Tuple
-from difflib import SequenceMatcher
+from types import MappingProxyType
+from typing import Dict, Any, List, Mapping, Optional, Tuple
+
+import numpy as np
+from rapidfuzz import fuzz, process
+
+try:
+    import orjson as _orjson   # быстрый парсер (bytes на вход, без декодирования в str)
+except Exception:
+    _orjson = None
 
 # Где искать базу
 SOURCE_FILES = [Path("data/catalog.json"), Path("data/brands_kb.json")]
 
 # ---------- загрузка базы ----------
+def _read_json(p: Path) -> Any:
+    raw = p.read_bytes()
+    if _orjson is not None:
+        try:
+            return _orjson.loads(raw)
+        except _orjson.JSONDecodeError:
+            pass   # orjson строже (NaN, огромные числа) — даём шанс stdlib
+    return json.loads(raw.decode("utf-8"))
+
+def _write_json(p: Path, data: Any) -> None:
+    """Компактно и атомарно: пишем во временный файл и подменяем."""
+    if _orjson is not None:
+        raw = _orjson.dumps(data, option=_orjson.OPT_NON_STR_KEYS)
+    else:
+        raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    tmp = p.with_suffix(".tmp")
+    tmp.write_bytes(raw)
+    tmp.replace(p)
+
 def _load_raw() -> List[Dict[str, Any]]:
     for p in SOURCE_FILES:
         if p.exists():
-            with p.open("r", encoding="utf-8") as f:
-                data = json.load(f)
+            data = _read_json(p)
             if isinstance(data, dict):
                 items: List[Dict[str, Any]] = []
                 for k, v in data.items():
@@ -36,30 +65,127 @@ def _load_raw() -> List[Dict[str, Any]]:
 
 RAW: List[Dict[str, Any]] = _load_raw()
 
+# Картинки, найденные ботом, живут отдельно от каталога:
+# {casefold(бренд): {"brand": имя как ввели, "image_url": url}} — ключ только для поиска
+_IMAGE_URLS_PATH = Path("data/image_urls.json")
+
+def _load_image_urls() -> Dict[str, Dict[str, str]]:
+    try:
+        data = _read_json(_IMAGE_URLS_PATH) if _IMAGE_URLS_PATH.exists() else {}
+    except Exception as e:
+        print(f"[brands] Failed to read {_IMAGE_URLS_PATH}: {e}")
+        data = {}
+    if not isinstance(data, dict):
+        return {}
+    out: Dict[str, Dict[str, str]] = {}
+    for key, v in data.items():
+        if isinstance(v, str):   # ранний формат {ключ: url} — имени нет, остаётся ключ
+            v = {"brand": key, "image_url": v}
+        if isinstance(v, dict) and v.get("image_url"):
+            out[key] = {"brand": v.get("brand") or key, "image_url": v["image_url"]}
+    return out
+
+_IMAGE_URLS: Dict[str, Dict[str, str]] = _load_image_urls()   # копия файла в памяти — на диск только пишем
+_BRAND_BY_LOWER: Dict[str, int] = {}                # casefold(бренд) -> индекс в RAW (первый выигрывает)
+
+def _brand_key(name: str) -> str:
+    # casefold, а не lower: корректное сравнение без учёта регистра и для кириллицы
+    return (name or "").strip().casefold()
+
+def _index_raw_by_brand() -> None:
+    _BRAND_BY_LOWER.clear()
+    # как прежний перебор каталога с break: записи, различающиеся регистром, — берём первую
+    for i, it in enumerate(RAW):
+        _BRAND_BY_LOWER.setdefault(_brand_key(it.get("brand")), i)
+
+def _apply_image_urls(items: List[Dict[str, str]]) -> None:
+    """Вливаем url в RAW: у кого есть photo_file_id/image_url — не трогаем, неизвестный бренд —
+    новая запись с исходным написанием имени."""
+    for item in items:
+        name, url = item["brand"], item["image_url"]
+        idx = _BRAND_BY_LOWER.get(_brand_key(name))
+        if idx is None:
+            _BRAND_BY_LOWER[_brand_key(name)] = len(RAW)
+            RAW.append({"brand": name, "image_url": url})
+        elif not RAW[idx].get("photo_file_id"):
+            RAW[idx].setdefault("image_url", url)
+
+_index_raw_by_brand()
+_apply_image_urls(list(_IMAGE_URLS.values()))
+
 # ---------- нормализация ----------
+_RE_WS  = re.compile(r"\s+")
+_RE_VOL = re.compile(r"\b(\d+[.,]?\d*)\s*(l|л|литр(а|ов)?|ml|мл)\b")
+_RE_NUM = re.compile(r"\b(0\.\d+|[1-9]\d*)\b")
+_RE_MANY_NL = re.compile(r"\n{3,}")
+
+# Нормализация — чистые функции от строки: одни и те же тексты (кнопки, частые бренды)
+# приходят постоянно, поэтому кэшируем. От каталога не зависят — сбрасывать не нужно.
+@lru_cache(maxsize=4096)
 def _norm_keep_numbers(s: str) -> str:
     """Нормализация с сохранением цифр (нужна для алиасов с 12/14/18 и т.п.)."""
     s = (s or "").lower().strip()
     s = s.replace("’", "'")
-    s = re.sub(r"\s+", " ", s)
+    s = _RE_WS.sub(" ", s)
     # убираем только объёмы/единицы, а ЦИФРЫ возраста оставляем
-    s = re.sub(r"\b(\d+[.,]?\d*)\s*(l|л|литр(а|ов)?|ml|мл)\b", " ", s)
-    s = re.sub(r"\s+", " ", s).strip()
+    s = _RE_VOL.sub(" ", s)
+    s = _RE_WS.sub(" ", s).strip()
     return s
 
-def _norm(s: str) -> str:
-    """Базовая нормализация (без цифр). Подходит для каноничных имен и свободного ввода."""
-    s = _norm_keep_numbers(s)
+@lru_cache(maxsize=4096)
+def _strip_numbers(s: str) -> str:
+    """Вторая ступень _norm: на вход — уже результат _norm_keep_numbers."""
     # убрать «голые» числа (0.7, 12 и т.д.)
-    s = re.sub(r"\b(0\.\d+|[1-9]\d*)\b", " ", s)
-    s = re.sub(r"\s+", " ", s).strip()
+    s = _RE_NUM.sub(" ", s)
+    s = _RE_WS.sub(" ", s).strip()
     return s
 
+def _norm(s: str) -> str:
+    """Базовая нормализация (без цифр). Подходит для каноничных имен и свободного ввода."""
+    return _strip_numbers(_norm_keep_numbers(s))
+
+# ---------- помощники ----------
+def _build_caption(entry: Dict[str, Any]) -> str:
+    brand   = entry.get("brand", "")
+    cat     = entry.get("category", "")
+    country = entry.get("country", "")
+    abv     = entry.get("abv", "")
+    notes   = entry.get("tasting_notes", "")
+    facts   = entry.get("production_facts", "")
+    sell    = entry.get("sales_script", "")
+
+    parts = [f"<b>{brand}</b>"]
+    meta = " · ".join(filter(None, (cat, country, abv)))
+    if meta: parts.append(f"<i>{meta}</i>")
+    if notes: parts.append(notes)
+    if facts: parts.append(facts)
+    if sell:  parts.append(f"<b>Как продавать:</b> {sell}")
+
+    caption = "\n".join(parts)
+    # пустые строки подряд возможны только из самих текстов каталога
+    if "\n\n\n" in caption:
+        caption = _RE_MANY_NL.sub("\n\n", caption)
+    caption = caption.strip()
+    if len(caption) > 1000:
+        caption = caption[:997] + "…"
+    return caption
+
 # ---------- индексация ----------
 NAME_INDEX: Dict[str, Dict[str, Any]] = {}   # norm(бренд без цифр) -> запись
 ALIASES_NUM: Dict[str, str] = {}             # norm_keep_numbers(алиас) -> канон. имя бренда (с цифрами!)
 ALIASES: Dict[str, str] = {}                 # norm(алиас без цифр) -> канон. имя бренда
 ALL_CANON: List[str] = []                    # список каноничных имён
+CATEGORY_INDEX: Dict[str, Tuple[str, ...]] = {}  # norm(категория) -> бренды (отсортированы)
+SUGGEST_NAMES: List[str] = []                # кандидаты для fuzzy_suggest (без дублей)
+_SUGGEST_NORM: List[str] = []                # norm(кандидат), параллельно SUGGEST_NAMES
+_SUGGEST_NORM_NUM: List[str] = []            # norm_keep_numbers(кандидат)
+# Подстрочный поиск одним str.find по склейке "a\0b\0c" вместо цикла по кандидатам:
+# (склейка, начала кусков) для _SUGGEST_NORM и _SUGGEST_NORM_NUM
+_SUGGEST_BLOB: Tuple[str, List[int]] = ("", [])
+_SUGGEST_BLOB_NUM: Tuple[str, List[int]] = ("", [])
+# Сводные таблицы для exact_lookup: по одному пробу на ступень нормализации
+_EXACT_NUM: Dict[str, str] = {}              # NAME_INDEX + ALIASES_NUM + ROOT_ALIASES (приоритет в этом порядке)
+_EXACT: Dict[str, str] = {}                  # NAME_INDEX + ALIASES
 
 # Корневые алиасы (короткие запросы одним словом)
 ROOT_ALIASES: Dict[str, str] = {
@@ -102,13 +228,44 @@ ROOT_ALIASES: Dict[str, str] = {
     _norm_keep_numbers("sailor jerry"): "Sailor Jerry Spiced Rum",
 }
 
+def _fill_card(entry: Dict[str, Any], brand: str) -> None:
+    # подпись не меняется до перезагрузки каталога — собираем один раз
+    entry["_caption"] = _build_caption(entry)
+    # готовая карточка для get_brand (только чтение — отдаём один и тот же объект)
+    entry["_card"] = MappingProxyType({
+        "name": brand,
+        "caption": entry["_caption"],
+        "photo_file_id": entry.get("photo_file_id"),  # может быть None
+        "image_url": entry.get("image_url"),          # опционально, если добавишь
+        "category": entry.get("category", ""),
+    })
+
+# поля, от которых зависят ключи индексов; остальные можно менять без пересборки
+_INDEXED_FIELDS = frozenset({"brand", "aliases", "category"})
+
+def _update_entry_in_place(brand_canon: str, **fields: Any) -> bool:
+    """Меняем поля записи прямо в NAME_INDEX (там ссылки на dict из RAW).
+    Полная пересборка — только если затронуты ключи индексов. False — бренда нет в индексе."""
+    entry = NAME_INDEX.get(_norm(brand_canon))
+    if entry is None:
+        return False
+    entry.update(fields)
+    if _INDEXED_FIELDS.intersection(fields):
+        _build_indexes()
+        return True
+    _fill_card(entry, entry["brand"].strip())
+    get_brand.cache_clear()   # в кэше лежат старые _card
+    return True
+
 def _build_indexes() -> None:
-    NAME_INDEX.clear(); ALIASES.clear(); ALIASES_NUM.clear(); ALL_CANON.clear()
+    _index_raw_by_brand()
+    NAME_INDEX.clear(); ALIASES.clear(); ALIASES_NUM.clear(); ALL_CANON.clear(); CATEGORY_INDEX.clear()
     for entry in RAW:
         brand = (entry.get("brand") or "").strip()
         if not brand:
             continue
         key = _norm(brand)
+        _fill_card(entry, brand)
         NAME_INDEX[key] = entry
         ALL_CANON.append(brand)
 
@@ -129,111 +286,117 @@ def _build_indexes() -> None:
         if _norm(canon) in NAME_INDEX:
             ALIASES_NUM.setdefault(k, canon)
 
-_build_indexes()
-
-# ---------- помощники ----------
-def _build_caption(entry: Dict[str, Any]) -> str:
-    brand   = entry.get("brand", "")
-    cat     = entry.get("category", "")
-    country = entry.get("country", "")
-    abv     = entry.get("abv", "")
-    notes   = entry.get("tasting_notes", "")
-    facts   = entry.get("production_facts", "")
-    sell    = entry.get("sales_script", "")
-
-    head = f"<b>{brand}</b>"
-    meta = " · ".join([x for x in [cat, country, abv] if x])
-    if meta: head += f"\n<i>{meta}</i>"
-
-    parts = [head]
-    if notes: parts.append(notes)
-    if facts: parts.append(facts)
-    if sell:  parts.append(f"<b>Как продавать:</b> {sell}")
-
-    caption = "\n".join(parts)
-    caption = re.sub(r"\n{3,}", "\n\n", caption).strip()
-    if len(caption) > 1000:
-        caption = caption[:997] + "…"
-    return caption
-
-def _similar(a: str, b: str) -> float:
-    return SequenceMatcher(None, a, b).ratio()
+    # Категории: строим по NAME_INDEX, чтобы совпадать с поиском по имени
+    buckets: Dict[str, List[str]] = {}
+    for entry in NAME_INDEX.values():
+        buckets.setdefault(_norm(entry.get("category", "")), []).append(entry["brand"])
+    CATEGORY_INDEX.update((cat, tuple(sorted(names))) for cat, names in buckets.items())
+
+    # Кандидаты подсказок и их нормализации — считаем один раз, а не на каждый запрос
+    SUGGEST_NAMES[:] = list(dict.fromkeys([*ALL_CANON, *ALIASES.values(), *ALIASES_NUM.values()]))
+    _SUGGEST_NORM[:] = [_norm(c) for c in SUGGEST_NAMES]
+    _SUGGEST_NORM_NUM[:] = [_norm_keep_numbers(c) for c in SUGGEST_NAMES]
+    global _SUGGEST_BLOB, _SUGGEST_BLOB_NUM
+    _SUGGEST_BLOB = _make_blob(_SUGGEST_NORM)
+    _SUGGEST_BLOB_NUM = _make_blob(_SUGGEST_NORM_NUM)
+
+    names = {k: e.get("brand") for k, e in NAME_INDEX.items()}
+    _EXACT_NUM.clear(); _EXACT_NUM.update(ROOT_ALIASES); _EXACT_NUM.update(ALIASES_NUM); _EXACT_NUM.update(names)
+    _EXACT.clear(); _EXACT.update(ALIASES); _EXACT.update(names)
+
+    _exact_lookup_cached.cache_clear()
+    get_brand.cache_clear()
+    _category_brands.cache_clear()
+
+def _make_blob(parts: List[str]) -> Tuple[str, List[int]]:
+    starts, pos = [], 0
+    for p in parts:
+        starts.append(pos)
+        pos += len(p) + 1
+    return "\0".join(parts), starts
+
+def _substring_hits(blob: Tuple[str, List[int]], needle: str) -> List[int]:
+    """Индексы кандидатов, содержащих needle (в needle нет \0 — кусок не пересекается)."""
+    text, starts = blob
+    out: List[int] = []
+    i = text.find(needle)
+    while i >= 0:
+        k = bisect_right(starts, i) - 1
+        out.append(k)
+        if k + 1 >= len(starts):
+            break
+        i = text.find(needle, starts[k + 1])
+    return out
 
 # ---------- ПУБЛИЧНОЕ API ----------
 def exact_lookup(text: str) -> Optional[str]:
-    """Ищем в 4 шага: NAME_INDEX -> ALIASES_NUM -> ROOT_ALIASES -> ALIASES."""
+    """Ищем в 4 шага: NAME_INDEX -> ALIASES_NUM -> ROOT_ALIASES -> ALIASES
+    (порядок зашит в _EXACT_NUM/_EXACT при сборке индексов)."""
+    # «Jameson» и « jameson» — один ключ кэша (нормализация всё равно их склеит)
+    return _exact_lookup_cached((text or "").strip().lower())
+
+@lru_cache(maxsize=2048)
+def _exact_lookup_cached(text: str) -> Optional[str]:
     key_num = _norm_keep_numbers(text)
-    if key_num in NAME_INDEX:
-        return NAME_INDEX[key_num].get("brand")
-    if key_num in ALIASES_NUM:
-        return ALIASES_NUM[key_num]
-    if key_num in ROOT_ALIASES:
-        return ROOT_ALIASES[key_num]
-
-    key = _norm(text)
-    if key in NAME_INDEX:
-        return NAME_INDEX[key].get("brand")
-    if key in ALIASES:
-        return ALIASES[key]
-    return None
-
-def get_brand(name: str) -> Optional[Dict[str, Any]]:
+    hit = _EXACT_NUM.get(key_num)
+    if hit is not None:
+        return hit
+    # обычный текст (не бренд) отсекается вторым пробом; нормализацию не повторяем
+    return _EXACT.get(_strip_numbers(key_num))
+
+@lru_cache(maxsize=4096)
+def get_brand(name: str) -> Optional[Mapping[str, Any]]:
+    """Карточка бренда (неизменяемая). Кэш сбрасывается при пересборке индексов."""
     canon = exact_lookup(name) or name
     entry = NAME_INDEX.get(_norm(canon))
     if not entry:
         return None
-    return {
-        "name": entry.get("brand", canon),
-        "caption": _build_caption(entry),
-        "photo_file_id": entry.get("photo_file_id"),  # может быть None
-        "image_url": entry.get("image_url"),          # опционально, если добавишь
-        "category": entry.get("category", "")
-    }
+    return entry["_card"]
+
+@lru_cache(maxsize=256)
+def _category_brands(q: str) -> Tuple[str, ...]:
+    """Все бренды категорий, где встречается q, по алфавиту. Кэш сбрасывается при пересборке индексов."""
+    # категорий немного — подстрочный поиск по ключам вместо прохода по всем брендам
+    hits = [names for cat, names in CATEGORY_INDEX.items() if q in cat]
+    if len(hits) == 1:
+        return hits[0]
+    # бренд лежит ровно в одной категории (ключ NAME_INDEX уникален) — дублей нет,
+    # бакеты уже отсортированы: сливаем без set() и полной сортировки
+    return tuple(merge(*hits))
 
 def by_category(cat_query: str, limit: int = 50) -> List[str]:
     q = _norm(cat_query)
-    out: List[str] = []
-    for entry in NAME_INDEX.values():
-        cat = _norm(entry.get("category", ""))
-        if q and q in cat:
-            b = entry.get("brand")
-            if b:
-                out.append(b)
-                if len(out) >= limit:
-                    break
-    return sorted(set(out))
+    if not q:
+        return []
+    return list(_category_brands(q)[:limit])
 
 def fuzzy_suggest(text: str, limit: int = 10) -> List[Tuple[str, float]]:
     t = (text or "").strip()
     if not t:
         return []
     t_norm_num = _norm_keep_numbers(t)
-    t_norm = _norm(t)
-
-    candidates = set(ALL_CANON)
-    for _, canon in ALIASES.items():
-        candidates.add(canon)
-    for _, canon in ALIASES_NUM.items():
-        candidates.add(canon)
-
-    # быстрые подстрочные попадания (и с цифрами, и без)
-    hits = [(c, 1.0) for c in candidates if (t_norm and t_norm in _norm(c)) or (t_norm_num and t_norm_num in _norm_keep_numbers(c))]
-
-    # похожесть
-    scored: List[Tuple[str, float]] = []
-    for c in candidates:
-        s1 = _similar(t_norm_num, _norm_keep_numbers(c))
-        s2 = _similar(t_norm, _norm(c))
-        s = max(s1, s2)
-        if s >= 0.6:
-            scored.append((c, s))
-
-    by_name: Dict[str, float] = {n: s for n, s in scored}
-    for n, s in hits:
-        by_name[n] = max(by_name.get(n, 0.0), s)
+    t_norm = _strip_numbers(t_norm_num)
+
+    if not SUGGEST_NAMES:
+        return []
+
+    # похожесть: весь список кандидатов одним вызовом cdist (C/SIMD), без цикла по парам
+    s_num = process.cdist([t_norm_num], _SUGGEST_NORM_NUM, scorer=fuzz.ratio, score_cutoff=60)[0]
+    s_plain = process.cdist([t_norm], _SUGGEST_NORM, scorer=fuzz.ratio, score_cutoff=60)[0]
+    scores = np.maximum(s_num, s_plain)
+    by_name: Dict[str, float] = {SUGGEST_NAMES[i]: float(scores[i]) / 100 for i in np.flatnonzero(scores)}
+
+    # быстрые подстрочные попадания (и с цифрами, и без) — в порядке кандидатов
+    hits = set(_substring_hits(_SUGGEST_BLOB, t_norm)) if t_norm else set()
+    if t_norm_num:
+        hits.update(_substring_hits(_SUGGEST_BLOB_NUM, t_norm_num))
+    for i in sorted(hits):
+        by_name[SUGGEST_NAMES[i]] = 1.0
 
     return sorted(by_name.items(), key=lambda x: x[1], reverse=True)[:limit]
 
+_build_indexes()
+
 # ---------- РУССКИЕ СИНОНИМЫ (если где-то импорт русскими именами) ----------
 по_категории = by_category
 точный_поиск = exact_lookup
@@ -242,68 +405,37 @@ def fuzzy_suggest(text: str, limit: int = 10) -> List[Tuple[str, float]]:
 # --- Автосохранение URL картинки в локальную базу ---
 def set_image_url_for_brand(name: str, url: str) -> bool:
     """
-    Если у бренда нет photo_file_id — сохраняем image_url в data/catalog.json.
+    Если у бренда нет photo_file_id — сохраняем image_url в data/image_urls.json
+    (маленький файл {casefold(бренд): {brand, image_url}}; каталог целиком не переписываем).
     Обновляем память и индексы, чтобы сработало без перезапуска.
     Возвращает True, если записали на диск.
     """
     try:
-        from pathlib import Path
-        import json
-
         name_clean = (name or "").strip()
         if not name_clean or not url:
             return False
 
-        path = Path("data/catalog.json")
-        # читаем существующее содержимое (список объектов)
-        data = []
-        if path.exists():
-            try:
-                raw = path.read_text(encoding="utf-8")
-                loaded = json.loads(raw)
-                data = loaded if isinstance(loaded, list) else []
-            except Exception:
-                data = []
-
-        # ищем запись по точному совпадению brand
-        idx = -1
-        for i, it in enumerate(data):
-            if (it.get("brand") or "").strip().lower() == name_clean.lower():
-                idx = i
-                break
-
-        if idx >= 0:
-            item = dict(data[idx])
-            # если уже есть file_id — ничего не трогаем
-            if item.get("photo_file_id"):
-                pass
-            else:
-                # не затираем существующий image_url, если он уже есть
-                item.setdefault("image_url", url)
-                data[idx] = item
-        else:
-            # новой записи достаточно brand + image_url
-            data.append({"brand": name_clean, "image_url": url})
-
-        # пишем на диск (красиво, UTF-8)
-        path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        # не затираем уже сохранённый url — как и image_url в самой карточке
+        key = _brand_key(name_clean)
+        if key not in _IMAGE_URLS:
+            _IMAGE_URLS[key] = {"brand": name_clean, "image_url": url}
+            _write_json(_IMAGE_URLS_PATH, _IMAGE_URLS)
 
         # --- Обновляем память и индексы, чтобы сразу заработало ---
         try:
-            # RAW и индексируются в этом модуле
-            global RAW
-            updated = False
-            for it in RAW:
-                if (it.get("brand") or "").strip().lower() == name_clean.lower():
-                    if not it.get("photo_file_id"):
-                        it.setdefault("image_url", url)
-                    updated = True
-                    break
-            if not updated:
-                RAW.append({"brand": name_clean, "image_url": url})
-
-            # пересобираем индексы
-            _build_indexes()
+            idx = _BRAND_BY_LOWER.get(key)
+            if idx is not None:
+                # бренд уже есть — меняется только image_url, ключи индексов те же
+                entry = RAW[idx]
+                if not entry.get("photo_file_id") and not entry.get("image_url"):
+                    entry["image_url"] = url
+                    # карточку пересобираем, только если get_brand отдаёт именно эту запись
+                    if NAME_INDEX.get(_norm(entry["brand"])) is entry:
+                        _update_entry_in_place(entry["brand"], image_url=url)
+            else:
+                # новая запись — без пересборки индексов её не найти
+                _apply_image_urls([{"brand": name_clean, "image_url": url}])
+                _build_indexes()
         except Exception:
             pass
 
@@ -1,6 +1,7 @@
 # app/services/extractors.py
 from __future__ import annotations
 import contextlib
+from functools import lru_cache
 
 from typing import Dict, Any, List, Optional
 import re
@@ -14,8 +15,9 @@ from app.settings import settings
 # =========================
 # Конфиг/разрешённые домены
 # =========================
-# Если список пустой – считаем, что разрешены все домены
-_ALLOWED = set(settings.allowed_domains_list or [])
+# Если список пустой – считаем, что разрешены все домены.
+# Поддомены разрешённых тоже проходят (m.winestyle.ru) — см. _is_allowed
+_ALLOWED = frozenset(d.removeprefix("www.") for d in settings.allowed_domains_list or [])
 
 # Единый заголовок клиента
 _HTTP_HEADERS = {
@@ -50,20 +52,31 @@ _CATS_CANON = {
 }
 
 _ABV_ANY = re.compile(r"(?<!\d)(\d{1,2}(?:[.,]\d)?)\s*%", re.I)
+_WS = re.compile(r"\s+")
+_SENT_SPLIT = re.compile(r"(?<=[\.\!\?])\s+")
 _SEO_TAIL = re.compile(r"(купить.*$|в\s+алматы.*$|с\s+доставк.*$|отличное качество.*$)", re.I)
 
+@lru_cache(maxsize=2048)   # один и тот же url проверяется в _is_allowed и parse_by_host
 def _domain(url: str) -> str:
     try:
         h = urlparse(url).hostname or ""
-        return h.lower().lstrip("www.")
+        return h.lower().removeprefix("www.")
     except Exception:
         return ""
 
 def _is_allowed(url: str) -> bool:
-    return not _ALLOWED or _domain(url) in _ALLOWED
+    if not _ALLOWED:
+        return True
+    # суффиксы хоста по меткам: a.b.c.ru -> a.b.c.ru, b.c.ru, c.ru — по хэш-пробе на каждый
+    host = _domain(url)
+    while host:
+        if host in _ALLOWED:
+            return True
+        _, _, host = host.partition(".")
+    return False
 
 def _clean_spaces(s: str | None) -> str:
-    return re.sub(r"\s+", " ", (s or "")).strip()
+    return _WS.sub(" ", (s or "")).strip()
 
 def _clean_title(t: str) -> str:
     t = _clean_spaces(t)
@@ -74,7 +87,7 @@ def _first_sentence(text: str, limit: int = 220) -> str:
     text = _clean_spaces(text)
     if not text:
         return ""
-    parts = re.split(r"(?<=[\.\!\?])\s+", text)
+    parts = _SENT_SPLIT.split(text)
     s = parts[0] if parts else text
     return (s[: limit - 1] + "…") if len(s) > limit else s
 
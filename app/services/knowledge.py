@@ -4,17 +4,46 @@ from typing import Any, Dict, List, Optional
 from pathlib import Path
 import json, re
 
+try:
+    import orjson
+    _jloads = orjson.loads
+except Exception:
+    _jloads = json.loads
+
 _KB_PATH = Path("data/brands_kb.json")
 
 try:
-    _KB: List[Dict[str, Any]] = json.loads(_KB_PATH.read_text(encoding="utf-8"))
+    _KB: List[Dict[str, Any]] = _jloads(_KB_PATH.read_bytes())
     if not isinstance(_KB, list):
         _KB = []
 except Exception:
     _KB = []
 
+_WS_RE = re.compile(r"\s+")
+
 def _norm(s: str | None) -> str:
-    return re.sub(r"\s+", " ", (s or "").strip()).lower()
+    return _WS_RE.sub(" ", (s or "").strip()).lower()
+
+def _hay(r: Dict[str, Any]) -> str:
+    return _norm(" ".join([
+        r.get("brand") or "",
+        " ".join(r.get("aliases", []) or []),
+        r.get("category") or "",
+        r.get("country") or "",
+        r.get("tasting_notes") or "",
+        r.get("production_facts") or "",
+        r.get("serve") or "",
+    ]))
+
+# Нормализованные ключи считаем один раз, а не для каждой записи на каждый запрос
+_BY_BRAND: Dict[str, Dict[str, Any]] = {}
+_BY_ALIAS: Dict[str, Dict[str, Any]] = {}
+_HAYS: List[tuple[str, str, Dict[str, Any]]] = []   # (текст для вхождения, norm(brand), запись)
+for _r in _KB:
+    _BY_BRAND.setdefault(_norm(_r.get("brand")), _r)    # первая запись выигрывает, как раньше
+    for _a in _r.get("aliases", []) or []:
+        _BY_ALIAS.setdefault(_norm(_a), _r)
+    _HAYS.append((_hay(_r), _norm(_r.get("brand")), _r))
 
 def find_record(brand_or_query: str) -> Optional[Dict[str, Any]]:
     """Поиск записи точным названием, алиасом, затем по вхождению."""
@@ -22,29 +51,16 @@ def find_record(brand_or_query: str) -> Optional[Dict[str, Any]]:
     if not q:
         return None
 
-    # 1) точное совпадение по полю brand
-    for r in _KB:
-        if _norm(r.get("brand")) == q:
-            return r
-
-    # 2) точное совпадение по алиасам
-    for r in _KB:
-        for a in r.get("aliases", []) or []:
-            if _norm(a) == q:
-                return r
+    # 1) точное совпадение по полю brand; 2) по алиасам
+    r = _BY_BRAND.get(q)
+    if r is None:
+        r = _BY_ALIAS.get(q)
+    if r is not None:
+        return r
 
     # 3) по вхождению в brand/aliases/ключевые поля
-    for r in _KB:
-        hay = " ".join([
-            r.get("brand") or "",
-            " ".join(r.get("aliases", []) or []),
-            r.get("category") or "",
-            r.get("country") or "",
-            r.get("tasting_notes") or "",
-            r.get("production_facts") or "",
-            r.get("serve") or "",
-        ])
-        if _norm(hay).find(q) != -1 or q.find(_norm(r.get("brand"))) != -1:
+    for hay, brand, r in _HAYS:
+        if q in hay or brand in q:
             return r
 
     return None
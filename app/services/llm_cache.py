@@ -0,0 +1,122 @@
+# app/services/llm_cache.py
+# Кэш ответов LLM:
+#   1) точное совпадение промпта — sha256 → память (L1) → Redis (L2, общий для процессов);
+#   2) семантическое — близкий по смыслу запрос (эмбеддинг SBERT, cos ≥ порога), только в памяти.
+#      Включается явно: LLM_CACHE_SEMANTIC=1 и установленный sentence-transformers (в requirements.txt
+#      его нет — пакет тяжёлый). Модель по умолчанию многоязычная: запросы у нас на русском.
+# Пространство имён (задача + модель) разделяет кэши: карточка не отдаётся вместо playbook,
+# ответ flash — вместо flash-lite. LLM_CACHE_VERSION меняем после обновления БЗ — старые ключи не читаются.
+from __future__ import annotations
+from typing import Optional
+import asyncio, hashlib, logging, os, threading, time
+
+import numpy as _np
+from cachetools import TTLCache
+
+from app.services.stats import MemoryRedis, redis
+
+log = logging.getLogger(__name__)
+
+_SEMANTIC = os.getenv("LLM_CACHE_SEMANTIC", "0").lower() in ("1", "true", "yes")
+_HAS_SBERT = False
+if _SEMANTIC:
+    try:
+        from sentence_transformers import SentenceTransformer
+        _HAS_SBERT = True
+    except Exception as e:
+        log.warning("llm_cache: LLM_CACHE_SEMANTIC=1, but sentence-transformers is unavailable: %s", e)
+
+_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))       # 7 дней
+_SIM_THRESHOLD = float(os.getenv("LLM_CACHE_SIM", "0.95"))
+_SBERT_MODEL_NAME = os.getenv("SBERT_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+_SEM_MAX = 2048
+_VERSION = os.getenv("LLM_CACHE_VERSION", "1")
+
+_L1: TTLCache = TTLCache(maxsize=4096, ttl=_TTL)
+
+# семантический слой по пространствам имён: строки матрицы эмбеддингов (нормированы) ↔ ответы
+_sem_emb: dict[str, _np.ndarray] = {}
+_sem_vals: dict[str, list[tuple[float, str]]] = {}    # ns -> [(истекает_в, html)]
+_sem_lock = threading.Lock()               # эмбеддинги считаются в потоках
+_model = None
+
+def _hash(ns: str, prompt: str) -> str:
+    return hashlib.sha256(f"{ns}\x00{prompt}".encode("utf-8")).hexdigest()
+
+def _redis_key(h: str) -> str:
+    return f"llm:cache:v{_VERSION}:{h}"
+
+# клиент redis синхронный — сетевой вызов уводим в поток, чтобы не стоял event loop;
+# запасной MemoryRedis в памяти процесса — зовём напрямую
+_REDIS_IS_REMOTE = not isinstance(redis, MemoryRedis)
+
+async def _redis_call(fn, *args, **kwargs):
+    if _REDIS_IS_REMOTE:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
+
+def _embed(text: str) -> Optional[_np.ndarray]:
+    global _model
+    if not _HAS_SBERT:
+        return None
+    try:
+        if _model is None:
+            _model = SentenceTransformer(_SBERT_MODEL_NAME)
+        return _model.encode([text], convert_to_numpy=True, show_progress_bar=False, normalize_embeddings=True)[0]
+    except Exception as e:
+        log.warning("llm_cache: embedding failed: %s", e)
+        return None
+
+def _sem_lookup(ns: str, text: str) -> Optional[str]:
+    with _sem_lock:
+        emb, vals = _sem_emb.get(ns), _sem_vals.get(ns)
+    if emb is None or not vals:
+        return None
+    q = _embed(text)
+    if q is None:
+        return None
+    sims = emb @ q
+    i = int(sims.argmax())
+    exp, html = vals[i]
+    if sims[i] >= _SIM_THRESHOLD and exp > time.time():
+        return html
+    return None
+
+def _sem_add(ns: str, text: str, html: str) -> None:
+    v = _embed(text)
+    if v is None:
+        return
+    row = v[None, :].astype(_np.float32)
+    with _sem_lock:
+        emb = _sem_emb.get(ns)
+        _sem_emb[ns] = row if emb is None else _np.vstack([emb, row])[-_SEM_MAX:]
+        _sem_vals[ns] = (_sem_vals.get(ns, []) + [(time.time() + _TTL, html)])[-_SEM_MAX:]
+
+async def lookup(ns: str, prompt: str, sem_text: Optional[str] = None) -> Optional[str]:
+    """Готовый ответ для промпта в пространстве ns: сначала точный (без эмбеддинга), затем по смыслу sem_text."""
+    h = _hash(ns, prompt)
+    hit = _L1.get(h)
+    if hit is not None:
+        return hit
+    try:
+        hit = await _redis_call(redis.get, _redis_key(h))
+    except Exception:
+        hit = None
+    if hit:
+        _L1[h] = hit
+        return hit
+    if sem_text:
+        return await asyncio.to_thread(_sem_lookup, ns, sem_text)
+    return None
+
+async def store(ns: str, prompt: str, html: str, sem_text: Optional[str] = None) -> None:
+    if not html:
+        return
+    h = _hash(ns, prompt)
+    _L1[h] = html
+    try:
+        await _redis_call(redis.set, _redis_key(h), html, ex=_TTL)
+    except Exception as e:
+        log.warning("llm_cache: redis set failed: %s", e)
+    if sem_text:
+        await asyncio.to_thread(_sem_add, ns, sem_text, html)
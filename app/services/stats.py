@@ -7,6 +7,15 @@ from typing import Dict, Any
 from redis import Redis
 from app.settings import settings
 
+try:
+    import orjson
+    _jloads = orjson.loads
+    def _jdumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+except Exception:
+    _jloads = json.loads
+    _jdumps = json.dumps
+
 TZ = ZoneInfo(settings.tz)
 
 DEFAULT_STATS = {
@@ -18,6 +27,7 @@ DEFAULT_STATS = {
     "best_assoc": 0,
     "best_blitz": 0,
 }
+_DEFAULT_BLOB = _jdumps(DEFAULT_STATS)   # сериализуем один раз
 
 def _now_str() -> str:
     return datetime.now(TZ).strftime("%Y-%m-%d %H:%M:%S")
@@ -37,7 +47,8 @@ class MemoryRedis:
     def get(self, key: str):
         return self.data.get(key)
 
-    def set(self, key: str, value: str) -> None:
+    def set(self, key: str, value: str, ex: int | None = None) -> None:
+        # срок жизни (ex) в заглушке не поддерживаем — данные живут до перезапуска
         self.data[key] = value
 
     def hincrby(self, name: str, key: str, amount: int) -> None:
@@ -78,15 +89,15 @@ def get_stats(user_id: int, period: str = "total") -> Dict[str, Any]:
     key = _stats_key(user_id, period)
     data = redis.get(key)
     if data is None:
-        redis.set(key, json.dumps(DEFAULT_STATS))
-        return DEFAULT_STATS.copy()
-    st = json.loads(data)
+        redis.set(key, _DEFAULT_BLOB)
+        data = _DEFAULT_BLOB   # свежий dict: вложенный "brands" не делим с DEFAULT_STATS
+    st = _jloads(data)
     st.setdefault("brands", {})
     return st
 
 def save_stats(user_id: int, stats: Dict[str, Any], period: str = "total") -> None:
     key = _stats_key(user_id, period)
-    redis.set(key, json.dumps(stats))
+    redis.set(key, _jdumps(stats))
 
 def record_history(event: str) -> None:
     now = datetime.now(TZ)
@@ -1,10 +1,20 @@
 
 import asyncio
 from flask import Flask, request, Response
+
+# uvloop — быстрее диспетчеризация цикла; необязателен (нет на Windows)
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except Exception:
+    pass
 from aiogram.types import Update
 
 from app.settings import settings
 from app.bot import bot, dp
+from app.routers.main import init_users, close_users
+from app.services.ai_gemini import warmup as warmup_gemini
+from app.services.ai_google import close_http
 
 WEBHOOK_PATH = f"/webhook/{settings.webhook_secret}"
 WEBHOOK_URL = settings.webhook_url + WEBHOOK_PATH if settings.webhook_url else ""
@@ -24,6 +34,8 @@ def hello():
     return "Bot is alive"
 
 async def main():
+    await init_users()
+    gemini_warmup = asyncio.create_task(warmup_gemini())   # параллельно с установкой вебхука
     if WEBHOOK_URL:
         await bot.set_webhook(WEBHOOK_URL)
         print(f"✅ Webhook установлен: {WEBHOOK_URL}")
@@ -33,7 +45,12 @@ async def main():
     import hypercorn.config
     config = hypercorn.config.Config()
     config.bind = ["0.0.0.0:10000"]
-    await hypercorn.asyncio.serve(app, config)
+    try:
+        await hypercorn.asyncio.serve(app, config)
+    finally:
+        gemini_warmup.cancel()
+        await close_http()
+        await close_users()
 
 if __name__ == "__main__":
     loop.run_until_complete(main())
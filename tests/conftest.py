@@ -0,0 +1,4 @@
+import os
+
+# Settings требует токен бота при импорте роутеров — в тестах подставляем фиктивный
+os.environ.setdefault("API_TOKEN", "123456:test")
@@ -0,0 +1,30 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText
+
+from app.routers import ai_helper
+
+
+def test_final_edit_retry_after_does_not_send_second_answer(monkeypatch):
+    async def stream(*_args, **_kwargs):
+        yield "<b>Как продавать</b>"
+        yield " — подробности."
+
+    retry = TelegramRetryAfter(method=EditMessageText(text="x"), message="Too Many Requests", retry_after=1)
+    preview = MagicMock()
+    preview.edit_text = AsyncMock(side_effect=retry)
+    m = MagicMock()
+    m.answer = AsyncMock(return_value=preview)
+    fallback = AsyncMock(return_value="<b>fallback</b>")
+
+    monkeypatch.setattr(ai_helper, "detect_sales_intent", lambda q: (True, None, "Brand"))
+    monkeypatch.setattr(ai_helper, "stream_sales_playbook_with_gemini", stream)
+    monkeypatch.setattr(ai_helper, "generate_sales_playbook_with_gemini", fallback)
+    monkeypatch.setattr(ai_helper.asyncio, "sleep", AsyncMock())
+
+    asyncio.run(ai_helper._answer_ai(m, "как продавать Brand"))
+
+    m.answer.assert_called_once()
+    fallback.assert_not_called()